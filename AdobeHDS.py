@@ -12,25 +12,103 @@ import math
 import xml.etree.ElementTree
 import xml.sax
 import re
-from urlparse import urlparse, urlunparse
+from urlparse import urlparse, urlunparse, urljoin
 import string
 import unicodedata
 import Queue
-import threading, thread
+import threading
 import time
-try:
-    import urllib3
-    from urllib3.exceptions import HTTPError
-    hasUrllib3 = True
-except ImportError:
-    import urllib2
-    from urllib2 import HTTPError
-    hasUrllib3 = False
+import asyncore
+import socket
+import heapq
+import random
+import mmap
+import tempfile
+import cStringIO
+import BaseHTTPServer
+import SocketServer
+import httplib
 import argparse
 import json
+import zlib
+import collections
+import hashlib
+try:
+    import FlvFixer
+except ImportError:
+    FlvFixer = None
+
+UInt8 = struct.Struct(">B")
+UInt16 = struct.Struct(">H")
+UInt32 = struct.Struct(">L")
+UInt64 = struct.Struct(">Q")
+BoxHeader = struct.Struct(">L4s")
+TagHeader = struct.Struct(">LL")
+Double = struct.Struct(">d")
+
+UserAgent = 'Mozilla/5.0 (iPhone; U; CPU iPhone OS 4_3_2 like Mac OS X; en-us) AppleWebKit/533.17.9 (KHTML, like Gecko) Version/5.0.2 Mobile/8H7 Safari/653.18.5'
 
 NumWorkerThreads = None
-currChunknum = None
+MaxWorkerThreads = 15
+Adaptive = False
+Engine = 'threads'
+MaxConnections = 64
+RequestTimeout = 60
+MaxRetries = 6
+RetryBackoff = 1.0
+MaxRetryBackoff = 60
+RetryableStatus = (408, 429, 500, 502, 503, 504)
+MaxBufferSize = 64 * 1024 * 1024
+Streaming = False
+Positional = False
+FollowLive = False
+LiveRefresh = 4.0
+LiveEdge = 2
+FixTimestamps = True
+# With --flvfix, every tag goes through FlvFixer.FlvFixer as it is written
+FlvFix = False
+ProgressInterval = None
+MaxHostConnections = None
+# With --hostoverflow, a busy host gets an extra connection instead of a wait
+HostOverflow = False
+# Port of a --proxy given without one
+DefaultProxyPort = 8080
+# Seconds --engine async reuses the address a host name was resolved to
+DnsCacheTTL = 300
+# Redirections followed for a single request
+MaxRedirects = 5
+# Seconds a manifest or bootstrap info is used before revalidating it
+CacheTTL = 60
+MaxCacheEntries = 32
+# Documents kept on disk with --doccache
+MaxCacheFiles = 1024
+# With --fragcache, a FragmentCache shared by every job
+fragmentCache = None
+# With --profile or addProfileHook, the Profiler timing every stage
+profiler = None
+# Spans the profiler keeps for the trace, the oldest ones are dropped
+MaxProfileSpans = 200000
+# With --hedge, a fragment still downloading after HedgePercentile of the
+# last HedgeSamples downloads (the median for the one the writer waits
+# on) gets a second request when a fetcher is idle
+Hedging = False
+HedgePercentile = 90
+HedgeSamples = 50
+LatencyBuckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+FixWindow = 1000
+FrameFixStep = 40
+ChunkSize = 256 * 1024
+
+class FetchError(Exception):
+    """
+    A request that failed, with the HTTP status when there was a response.
+    Network errors and throttling or server errors are worth retrying,
+    other statuses (403, 404...) will not get better.
+    """
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        self.status = status
+        self.retryable = status is None or status in RetryableStatus
 
 class GetUrl(object):
     def __init__(self, url, chunknum, fragnum):
@@ -38,95 +116,2295 @@ class GetUrl(object):
         self.chunkNum = chunknum
         self.fragNum = fragnum
         self.data = None
+        self.info = None
+        self.payload = None
+        self.crc = None
         self.errCount = 0
+        self.spool = None
+        # Shared with the other request when the fragment is hedged
+        self.hedge = None
+        self.cancel = None
+        self.duplicate = False
+        # When it was put in queueUrl and in queueUrlDone, for the profiler
+        self.queued = time.time()
+        self.stored = None
+
+    def openSpool(self, dirname):
+        """
+        Start a temporary file to stream the fragment body to
+        """
+        self.release()
+        self.spool = tempfile.TemporaryFile(dir=dirname)
+        return self.spool
+
+    def mapSpool(self):
+        # The fragment is read back through the page cache, not the heap
+        self.spool.flush()
+        if self.spool.tell() == 0:
+            self.data = ''
+        else:
+            self.data = mmap.mmap(self.spool.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def release(self):
+        self.data = None
+        self.payload = None
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+
+class FragmentInfo(object):
+    """
+    What a single pass over a fragment found: the mdat bounds, the FLV
+    tags as (offset, type, size, timestamp), the DRM in use if any and
+    where the payload to write starts
+    """
+    def __init__(self, mdatStart, mdatEnd):
+        self.mdatStart = mdatStart
+        self.mdatEnd = mdatEnd
+        self.tags = []
+        self.drm = None
+        self.payloadStart = mdatStart
+
+def readBoxHeader(data, pos=0):
+    boxSize, boxType = BoxHeader.unpack_from(data, pos)  # Read 32 bits (big endian) and the box type
+    if boxSize == 1:
+        boxSize, = UInt64.unpack_from(data, pos + 8)  # Read 64 bits (big endian)
+        boxSize -= 16
+        pos += 16
+    else:
+        boxSize -= 8
+        pos += 8
+    if boxSize <= 0:
+        boxSize = 0
+    return (pos, boxType, boxSize)
+
+def flvTags(data, pos, end):
+    """
+    Walk the FLV tags between pos and end, yielding (offset, type, size,
+    timestamp) for each
+    """
+    while pos < end:
+        tagType, tagTS = TagHeader.unpack_from(data, pos)
+        packetType = tagType >> 24
+        packetSize = tagType & 0x00FFFFFF
+        packetTS = (tagTS >> 8) | ((tagTS & 0xFF) << 24)
+        if packetTS & 0x80000000:
+            packetTS &= 0x7FFFFFFF
+        yield (pos, packetType, packetSize, packetTS)
+        # Tag header, data and previous tag size
+        pos += 11 + packetSize + 4
+
+def parseFragment(fragNum, data):
+    """
+    Verify and decode a fragment in a single pass over its boxes and FLV
+    tags.  Returns a FragmentInfo, or None when the fragment has no
+    complete mdat box.
+    """
+    fragPos = 0
+    fragLen = len(data)
+    info = None
+    while fragPos < fragLen:
+        fragPos, boxType, boxSize = readBoxHeader(data, fragPos)
+        if boxType == 'mdat':
+            if boxSize and fragLen - fragPos == boxSize:
+                info = FragmentInfo(fragPos, fragPos + boxSize)
+            break
+        fragPos += boxSize
+    if info is None:
+        return None
+
+    tags = info.tags
+    for tag in flvTags(data, fragPos, info.mdatEnd):
+        if tag[1] in (10, 11):
+            info.drm = 'Akamai DRM'
+            break
+        if tag[1] in (40, 41):
+            info.drm = 'FlashAccess DRM'
+            break
+        tags.append(tag)
+
+    # For all fragment (except frag1), skip 2 FLV tags
+    if fragNum != 1:
+        if len(tags) > 2:
+            info.payloadStart = tags[2][0]
+        else:
+            info.payloadStart = info.mdatEnd
+    return info
 
-QueueUrl = Queue.PriorityQueue()
-QueueUrlDone = Queue.PriorityQueue()
+def flvTimestamp(ts):
+    # 24 bits and the extended byte, as in the tag header
+    return UInt32.pack(((ts & 0x00FFFFFF) << 8) | ((ts >> 24) & 0xFF))
+
+def tagsCrc(data, pos=0, end=None):
+    """
+    CRC32 of data between pos and end leaving out the timestamps of the
+    FLV tags, so that it holds whatever timestamps the writer sets
+    """
+    if end is None:
+        end = len(data)
+    crc = 0
+    while pos + 11 <= end:
+        tagLen = 11 + (UInt32.unpack_from(data, pos)[0] & 0x00FFFFFF) + 4
+        if pos + tagLen > end:
+            break
+        crc = zlib.crc32(buffer(data, pos, 4), crc)
+        crc = zlib.crc32(buffer(data, pos + 8, tagLen - 8), crc)
+        pos += tagLen
+    return zlib.crc32(buffer(data, pos, end - pos), crc) & 0xffffffff
+
+def writePatched(fout, payload, patches):
+    """
+    Write payload with the tag timestamps in patches (offset of the tag in
+    payload, new timestamp) changed
+    """
+    pos = 0
+    for offset, ts in patches:
+        fout.write(buffer(payload, pos, offset + 4 - pos))
+        fout.write(flvTimestamp(ts))
+        pos = offset + 8
+    fout.write(buffer(payload, pos))
+
+def lastTimestamps(f, end):
+    """
+    Timestamps of the last audio and video tags of the FLV in f before
+    end, walking back along the previous tag sizes
+    """
+    prevTS = {}
+    pos = end
+    while pos > 13 and len(prevTS) < 2:
+        f.seek(pos - 4)
+        tagLen, = UInt32.unpack(f.read(4))
+        if tagLen < 11 or tagLen > pos - 17:
+            break
+        pos -= 4 + tagLen
+        f.seek(pos)
+        offset, packetType, packetSize, packetTS = flvTags(f.read(8), 0, 1).next()
+        if packetType in (8, 9):
+            prevTS.setdefault(packetType, packetTS)
+    return prevTS
+
+class TimestampFixer(object):
+    """
+    Makes the tag timestamps zero based and continuous from one fragment
+    to the next, as DecodeFragment in AdobeHDS.php does: gaps (missing
+    fragments, discontinuities) are closed, jumps back are moved after
+    the last tag written, and fragments that repeat the time range of
+    the previous one are dropped as duplicates
+    """
+    def __init__(self):
+        self.shift = None
+        self.prevTS = {}
+        self.lastTS = None
+        self.prevRange = None
+
+    def resume(self, prevTS, state=()):
+        """
+        Carry on after the tags already written, prevTS holding the
+        timestamp of the last audio (8) and video (9) tags and state what
+        state() returned after them
+        """
+        self.prevTS = dict(prevTS)
+        if prevTS:
+            self.lastTS = max(prevTS.values())
+        if state:
+            self.shift, = state
+
+    def state(self):
+        # For the journal, to resume with the same shift
+        if self.shift is None:
+            return ()
+        return (self.shift,)
+
+    def fix(self, fragNum, tags):
+        """
+        Return (offset, new timestamp) for the tags (offset, type, size,
+        timestamp) that need a new timestamp, or None to drop the fragment
+        """
+        media = [tag[3] for tag in tags if tag[1] in (8, 9)]
+        if media:
+            first = media[0]
+            last = max(media)
+            if self.prevRange and self.prevRange[0] <= first and last <= self.prevRange[1]:
+                print 'Fragment', fragNum, 'repeats the previous one, dropped'
+                return None
+            self.prevRange = (first, last)
+            if self.lastTS is None:
+                self.shift = -first if first > 1000 else 0
+            elif self.shift is None:
+                # Resumed without the shift: keep the timestamps unless
+                # they do not follow the ones written
+                self.shift = 0
+                if abs(first - self.lastTS) > FixWindow:
+                    self.shift = self.lastTS + FrameFixStep - first
+            elif abs(first + self.shift - self.lastTS) > FixWindow:
+                print 'Timestamp gap of %d ms before fragment %d' % (
+                    first + self.shift - self.lastTS, fragNum)
+                self.shift = self.lastTS + FrameFixStep - first
+        shift = self.shift or 0
+        patches = []
+        for offset, packetType, packetSize, packetTS in tags:
+            ts = max(packetTS + shift, 0)
+            if packetType in (8, 9):
+                # Keep each stream in order
+                ts = max(ts, self.prevTS.get(packetType, 0))
+                self.prevTS[packetType] = ts
+                if self.lastTS is None or ts > self.lastTS:
+                    self.lastTS = ts
+            if ts != packetTS:
+                patches.append((offset, ts))
+        return patches
+
+class ReorderBuffer(object):
+    """
+    Holds the fragments downloaded ahead of the writer, keyed by fragment
+    number, and hands them back in order.  Once more than maxSize bytes are
+    held, fetchers are kept waiting until the writer catches up, unless the
+    fragment the writer needs is not being fetched by anybody yet.
+    """
+    def __init__(self, maxSize, firstFrag=1):
+        self.maxSize = maxSize
+        self.nextFrag = firstFrag
+        self.size = 0
+        self.items = {}
+        self.fetching = set()
+        # Time the writer spent waiting for the next fragment
+        self.waitTime = 0
+        self.cond = threading.Condition()
+
+    def itemSize(self, item):
+        # Fragments already written out (--positional) take no room
+        if item.data is None:
+            return 0
+        return len(item.data)
+
+    def hasRoom(self):
+        if self.size < self.maxSize:
+            return True
+        return self.nextFrag not in self.items and \
+               self.nextFrag not in self.fetching
+
+    def waitForRoom(self, timeout=1):
+        with self.cond:
+            if not self.hasRoom():
+                self.cond.wait(timeout)
+            return self.hasRoom()
+
+    def startFetch(self, fragNum):
+        with self.cond:
+            self.fetching.add(fragNum)
+
+    def cancelFetch(self, fragNum):
+        with self.cond:
+            self.fetching.discard(fragNum)
+            self.cond.notify_all()
+
+    def put(self, item):
+        st = time.time()
+        with self.cond:
+            locked = time.time()
+            self.fetching.discard(item.fragNum)
+            if item.fragNum >= self.nextFrag and item.fragNum not in self.items:
+                item.stored = locked
+                self.items[item.fragNum] = item
+                self.size += self.itemSize(item)
+                self.cond.notify_all()
+        if profiler:
+            profiler.record('reorderLock', item, st, locked)
+
+    def getRun(self, timeout=1):
+        """
+        Return the longest run of in-order fragments available, waiting up
+        to timeout seconds for the next one to arrive
+        """
+        idle = None
+        with self.cond:
+            if self.nextFrag not in self.items:
+                st = time.time()
+                self.cond.wait(timeout)
+                idle = (st, time.time())
+                self.waitTime += idle[1] - st
+            taken = time.time()
+            run = []
+            while self.nextFrag in self.items:
+                item = self.items.pop(self.nextFrag)
+                self.size -= self.itemSize(item)
+                run.append(item)
+                self.nextFrag += 1
+            if run:
+                self.cond.notify_all()
+        if profiler:
+            if idle:
+                profiler.record('writerIdle', None, *idle)
+            for item in run:
+                profiler.record('reorder', item, item.stored, taken)
+        return run
 
-M6Item = None
+    def empty(self):
+        with self.cond:
+            return not self.items
 
-def workerRun():
-    global QueueUrl, QueueUrlDone, M6Item
-    while not QueueUrl.empty() and M6Item.status == 'DOWNLOADING':
-        item = QueueUrl.get()[1]
-        fragUrl = item.url
+    def flush(self):
+        with self.cond:
+            items = [self.items[k] for k in sorted(self.items)]
+            self.items = {}
+            self.size = 0
+            self.cond.notify_all()
+            return items
+
+class FragmentJournal(object):
+    """
+    Sidecar of the output file listing every fragment written to it as
+    'fragment offset length tagsCrc', so that an interrupted download can
+    carry on from the last fragment known to be on disk.  Each line may
+    end with the state of the timestamp fixer after that fragment.  The
+    fragments the fixer dropped are listed with a length of 0.
+    """
+    def __init__(self, filename, header):
+        self.filename = filename
+        self.header = header
+        self.entries = []
+        self.states = {}
+        # Fixer state after the last fragment kept by resume()
+        self.state = ()
+        self.f = None
+
+    def resume(self, outFilename, ordered=True):
+        """
+        Return (next fragment, offset to truncate the output file at) from
+        a previous run, or (1, 0) when there is nothing to resume.  When
+        the fragments were not written in order, the next fragment is
+        always 1 and the entries kept tell which ones are on disk.
+        """
         try:
-            item.data = M6Item.getFile(fragUrl)
-            QueueUrlDone.put((item.fragNum, item))
-        except HTTPError, e:
-            print sys.exc_info()
-            traceback.print_exc(file=sys.stdout)
-            if item.errCount > 3:
-                M6Item.status = 'STOPPED'
-                # raise
+            with open(self.filename, "r") as f:
+                lines = f.read().splitlines()
+        except IOError:
+            return (1, 0)
+        if not lines or lines[0] != self.header or not os.path.exists(outFilename):
+            return (1, 0)
+
+        entries = []
+        states = {}
+        for line in lines[1:]:
+            try:
+                fields = [int(x, 16) for x in line.split()]
+                fragNum, offset, length, crc = fields[:4]
+            except ValueError:
+                break
+            if fragNum in states or (ordered and fragNum != len(entries) + 1):
+                break
+            states[fragNum] = tuple(fields[4:])
+            entries.append((fragNum, offset, length, crc))
+
+        # Only trust the last fragment if it reads back intact
+        fileSize = os.path.getsize(outFilename)
+        with open(outFilename, "rb") as f:
+            while entries:
+                fragNum, offset, length, crc = entries[-1]
+                if offset + length <= fileSize:
+                    f.seek(offset)
+                    data = f.read(length)
+                    # Journals from before tagsCrc hold the plain CRC32
+                    if crc in (tagsCrc(data), zlib.crc32(data) & 0xffffffff):
+                        break
+                entries.pop()
+        if not entries:
+            return (1, 0)
+        self.entries = entries
+        self.states = states
+        self.state = states[entries[-1][0]]
+        if not ordered:
+            return (1, max(offset + length for fragNum, offset, length, crc in entries))
+        fragNum, offset, length, crc = entries[-1]
+        return (fragNum + 1, offset + length)
+
+    def open(self):
+        # Rewrite the entries kept by resume() and drop the others
+        self.f = open(self.filename, "w")
+        self.f.write(self.header + "\n")
+        for entry in self.entries:
+            self.write(entry + self.states.get(entry[0], ()))
+        self.f.flush()
+
+    def write(self, fields):
+        self.f.write(" ".join("%x" % field for field in fields) + "\n")
+
+    def append(self, fragNum, offset, length, crc, state=()):
+        self.write((fragNum, offset, length, crc) + tuple(state))
+        self.f.flush()
+
+    def close(self, remove=False):
+        if self.f:
+            self.f.close()
+            self.f = None
+        if remove and os.path.exists(self.filename):
+            os.remove(self.filename)
+
+class FragmentFile(object):
+    """
+    Staging file of --positional.  Fetchers write each fragment as soon
+    as it is decoded, at the next free offset and through a file handle
+    of their own, so fragments land in any order and in parallel.  The
+    journal keeps where each one went, and finish() puts them in order.
+    """
+    def __init__(self, job, filename, journal, offset=0):
+        self.filename = filename
+        self.journal = journal
+        self.extents = {}
+        for fragNum, start, length, crc in journal.entries:
+            self.extents[fragNum] = (start, length)
+        header = cStringIO.StringIO()
+        job.videoBootstrap(header)
+        self.headerLen = header.tell()
+        if offset:
+            f = open(filename, "r+b")
+            f.truncate(offset)
+            self.end = offset
+        else:
+            f = open(filename, "wb")
+            f.write(header.getvalue())
+            self.end = self.headerLen
+        f.close()
+        self.local = threading.local()
+        self.fds = []
+        self.writing = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def handle(self):
+        fd = getattr(self.local, 'fd', None)
+        if fd is None:
+            fd = os.open(self.filename, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+            self.local.fd = fd
+            with self.cond:
+                self.fds.append(fd)
+        return fd
+
+    def write(self, item):
+        length = len(item.payload)
+        with self.cond:
+            if self.closed or item.fragNum in self.extents:
+                return
+            offset = self.end
+            self.end += length
+            self.writing += 1
+        try:
+            fd = self.handle()
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = 0
+            while written < length:
+                written += os.write(fd, buffer(item.payload, written))
+        finally:
+            with self.cond:
+                self.writing -= 1
+                self.cond.notify_all()
+        with self.cond:
+            self.extents[item.fragNum] = (offset, length)
+            self.journal.append(item.fragNum, offset, length, item.crc)
+
+    def close(self):
+        # Wait for the writes in progress, later ones are dropped
+        with self.cond:
+            self.closed = True
+            while self.writing:
+                self.cond.wait()
+            for fd in self.fds:
+                os.close(fd)
+            self.fds = []
+
+    def finish(self, outFilename, nbFragments, fixer=None):
+        """
+        Write fragments 1 to nbFragments in order to outFilename, with the
+        timestamps fixed by fixer.  When they already follow each other in
+        the staging file, it is only patched, truncated and renamed.
+        """
+        self.close()
+        f = open(self.filename, "r+b")
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        plan = []
+        inOrder = True
+        end = self.headerLen
+        for fragNum in range(1, nbFragments + 1):
+            start, length = self.extents[fragNum]
+            patches = []
+            if fixer:
+                patches = fixer.fix(fragNum, list(flvTags(data, start, start + length)))
+                if patches is None:
+                    inOrder = False
+                    continue
+            if start != end:
+                inOrder = False
+            end = start + length
+            plan.append((start, length, patches))
+
+        if inOrder:
+            for start, length, patches in plan:
+                for offset, ts in patches:
+                    f.seek(offset + 4)
+                    f.write(flvTimestamp(ts))
+            data.close()
+            f.truncate(end)
+            f.close()
+            if os.path.exists(outFilename):
+                os.remove(outFilename)
+            os.rename(self.filename, outFilename)
+            return
+
+        print 'Putting fragments in order'
+        with open(outFilename, "wb") as fout:
+            fout.write(data[:self.headerLen])
+            for start, length, patches in plan:
+                writePatched(fout, buffer(data, start, length),
+                             [(offset - start, ts) for offset, ts in patches])
+        data.close()
+        f.close()
+        os.remove(self.filename)
+
+def storeFragment(job, item):
+    """
+    Hand a decoded fragment to the writer, writing it out first with
+    --positional so that only its number waits in the reorder buffer
+    """
+    if job.output is not None and item.info is not None:
+        st = time.time()
+        job.output.write(item)
+        if profiler:
+            profiler.record('write', item, st)
+        item.release()
+    job.queueUrlDone.put(item)
+
+def prepareFragment(job, item):
+    """
+    Decode a downloaded fragment so the writer only has to write it
+    """
+    st = time.time()
+    item.info = job.parseFragment(item.fragNum, item.data)
+    if profiler:
+        profiler.record('decode', item, st)
+    if item.info is not None:
+        if item.info.drm:
+            print "This stream is encrypted with %s. Decryption of such streams isn't currently possible with this script." % item.info.drm
+            raise Exception(item.info.drm)
+        item.payload = buffer(item.data, item.info.payloadStart)
+        item.crc = tagsCrc(item.data, item.info.payloadStart)
+
+class RetryScheduler(object):
+    """
+    Puts failed fragments back in the queue of their job once their
+    backoff delay is over
+    """
+    def __init__(self):
+        self.heap = []
+        self.thread = None
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def schedule(self, job, item, delay):
+        with self.cond:
+            heapq.heappush(self.heap, (time.time() + delay, item.fragNum, job, item))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def run(self):
+        with self.cond:
+            while not self.closed:
+                now = time.time()
+                while self.heap and self.heap[0][0] <= now:
+                    when, fragNum, job, item = heapq.heappop(self.heap)
+                    if job.status == 'DOWNLOADING':
+                        job.queueUrlDone.cancelFetch(item.fragNum)
+                        item.queued = time.time()
+                        job.queueUrl.put((item.fragNum, item))
+                if self.heap:
+                    self.cond.wait(self.heap[0][0] - now)
+                else:
+                    self.cond.wait()
+
+class CircuitBreaker(object):
+    """
+    Stops sending requests to a host after threshold failures in a row,
+    for a cooldown that doubles each time a trial request fails again
+    """
+    def __init__(self, threshold=5, cooldown=5, maxCooldown=120):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.maxCooldown = maxCooldown
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def blockedFor(self, host):
+        """
+        Seconds to wait before sending a request to host.  Once the
+        cooldown is over, a single caller gets through to try the host.
+        """
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None or state['openUntil'] is None:
+                return 0
+            now = time.time()
+            if now < state['openUntil']:
+                return state['openUntil'] - now
+            state['openUntil'] = now + state['cooldown']
+            return 0
+
+    def remaining(self, host):
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None or state['openUntil'] is None:
+                return 0
+            return max(0, state['openUntil'] - time.time())
+
+    def success(self, host):
+        with self.lock:
+            self.hosts.pop(host, None)
+
+    def failure(self, host):
+        with self.lock:
+            state = self.hosts.setdefault(host, {'failures': 0, 'openUntil': None,
+                                                 'cooldown': self.cooldown})
+            state['failures'] += 1
+            if state['failures'] >= self.threshold:
+                if state['openUntil'] is not None:
+                    state['cooldown'] = min(state['cooldown'] * 2, self.maxCooldown)
+                state['openUntil'] = time.time() + state['cooldown']
+                print 'Too many errors from %s, pausing requests for %d s' % (host, state['cooldown'])
+
+def retryFragment(pool, job, item, error):
+    """
+    Give a fragment that failed another try after an exponential backoff
+    with jitter, or stop its job when retrying cannot help
+    """
+    host = urlparse(item.url).netloc
+    if job.guessed and error.status == 404:
+        # Past the last fragment of a stream whose length was guessed
+        print 'Fragment', item.fragNum, 'not found, end of the stream'
+        item.release()
+        item.info = None
+        job.queueUrlDone.put(item)
+        return
+    pool.breaker.failure(host)
+    # At the live edge, a fragment can be listed before every server has it
+    retryable = error.retryable or (job.following and error.status == 404)
+    if not retryable or item.errCount >= MaxRetries:
+        print 'Fragment', item.fragNum, 'failed:', error
+        job.status = 'STOPPED'
+        job.errQueue.put(str(error))
+        return
+    item.errCount += 1
+    job.metrics.recordRetry()
+    delay = random.uniform(0, min(MaxRetryBackoff, RetryBackoff * 2 ** item.errCount))
+    delay = max(delay, pool.breaker.remaining(host))
+    print 'Fragment %d failed (%s), retry %d in %.1f s' % (item.fragNum, error, item.errCount, delay)
+    pool.retries.schedule(job, item, delay)
+
+def failJob(job, error):
+    print sys.exc_info()
+    traceback.print_exc(file=sys.stdout)
+    job.status = 'STOPPED'
+    job.errQueue.put(error)
+
+class Hedge(object):
+    """
+    The two requests for a hedged fragment: the first one to download it
+    is used and the other is cancelled.  The fragment is only retried
+    when both fail.
+    """
+    def __init__(self, cancel=None):
+        self.winner = None
+        self.pending = 2
+        self.cancel = cancel
+        self.lock = threading.Lock()
+
+    def claim(self, item):
+        with self.lock:
+            self.pending -= 1
+            if self.winner is not None:
+                return False
+            self.winner = item
+            if self.cancel is not None:
+                self.cancel.set()
+            return True
+
+    def failed(self):
+        """
+        Return whether the other request won or may still win
+        """
+        with self.lock:
+            self.pending -= 1
+            return self.winner is not None or self.pending > 0
+
+def hedgeCandidate(inFlight, latencies):
+    """
+    Pick among inFlight ({item: (job, start time)}) the fragment most
+    overdue compared to latencies, the recent download times, and return
+    its job with a duplicate request for it, or None
+    """
+    if not Hedging or len(latencies) < HedgeSamples // 2:
+        return None
+    ordered = sorted(latencies)
+    median = ordered[len(ordered) // 2]
+    slow = ordered[min(len(ordered) - 1, len(ordered) * HedgePercentile // 100)]
+    now = time.time()
+    best = None
+    for item, (job, st) in inFlight.items():
+        if item.hedge is not None or job.status != 'DOWNLOADING':
+            continue
+        # The writer is stuck until this one arrives
+        if item.fragNum == job.queueUrlDone.nextFrag:
+            late = now - st - median
+        else:
+            late = now - st - slow
+        if late > 0 and (best is None or late > best[0]):
+            best = (late, job, item)
+    if best is None:
+        return None
+    late, job, item = best
+    duplicate = GetUrl(item.url, item.chunkNum, item.fragNum)
+    duplicate.duplicate = True
+    duplicate.cancel = item.cancel
+    item.hedge = duplicate.hedge = Hedge(item.cancel)
+    job.metrics.recordHedge()
+    return (job, duplicate)
+
+def hedgeFailed(item):
+    """
+    Return whether a failed request can be dropped, the other request
+    for its fragment having won or still running
+    """
+    if item.hedge is None:
+        return False
+    if item.hedge.failed():
+        item.release()
+        return True
+    # Retried as a plain fragment
+    item.hedge = None
+    item.cancel = None
+    item.duplicate = False
+    return False
+
+class ConcurrencyController(object):
+    """
+    Adapts how many fragments are fetched at once, AIMD-style, from what
+    the last window of fetches measured: one more fetcher while nothing
+    fails, half as many after errors, and a step back when the latency
+    grows without any gain in throughput
+    """
+    def __init__(self, limit, maxLimit, window=2):
+        self.limit = min(limit, maxLimit)
+        self.maxLimit = maxLimit
+        self.window = window
+        self.prevRate = None
+        self.minLatency = None
+        self.lock = threading.Lock()
+        self.resetWindow()
+
+    def resetWindow(self):
+        self.start = time.time()
+        self.size = 0
+        self.count = 0
+        self.errors = 0
+        self.latency = 0.0
+
+    def record(self, latency, size, ok=True):
+        with self.lock:
+            if ok:
+                self.count += 1
+                self.size += size
+                self.latency += latency
             else:
-                item.errCount += 1
-                QueueUrl.put((item.fragNum, item))
-        QueueUrl.task_done()
-    # If we have exited the previous loop with error
-    while not QueueUrl.empty():
-        QueueUrl.get()
+                self.errors += 1
+            now = time.time()
+            if now - self.start >= self.window and \
+               self.count + self.errors >= self.limit:
+                self.adjust(now)
 
-def worker(errQueue):
-    error = None
-    try:
-        workerRun()
-    except Exception as e:
-        print sys.exc_info()
-        traceback.print_exc(file=sys.stdout)
-        error = str(e)
-        M6Item.status = 'STOPPED'
-        thread.interrupt_main()
+    def adjust(self, now):
+        rate = self.size / (now - self.start)
+        errorRate = float(self.errors) / (self.count + self.errors)
+        latency = self.latency / self.count if self.count else 0
+        if self.count and (self.minLatency is None or latency < self.minLatency):
+            self.minLatency = latency
 
-    if error:
-        errQueue.put(error)
-
-def workerqdRun():
-    global QueueUrlDone, M6Item, currChunknum
-    currentFrag = 1
-    outFile = open(M6Item.localfilename, "wb")
-    while currentFrag <= M6Item.nbFragments and M6Item.status == 'DOWNLOADING':
-        item = QueueUrlDone.get()[1]
-        requeue = False
-        if currChunknum == item.chunkNum and currentFrag == item.fragNum:
-            # M6Item.verifyFragment(item.data)
-            if not M6Item.decodeFragment(item.fragNum, item.data):
-                M6Item.status = 'FINISHED'
+        old = self.limit
+        if self.errors:
+            self.limit = max(1, self.limit // 2)
+            reason = 'errors'
+        elif self.prevRate and rate < self.prevRate * 0.9 and \
+             latency > 2 * self.minLatency:
+            self.limit = max(1, self.limit - 1)
+            reason = 'latency up, throughput down'
+        elif self.limit < self.maxLimit:
+            self.limit += 1
+            reason = 'probing'
+        else:
+            reason = 'at maximum'
+        if self.limit != old:
+            print 'Concurrency %d -> %d (%s): %.0f kB/s, %.0f%% errors, %.0f ms per fragment' % (
+                old, self.limit, reason, rate / 1024, errorRate * 100, latency * 1000)
+        self.prevRate = rate
+        self.resetWindow()
+
+class Cancellation(object):
+    """
+    Lets a thread stop the downloads of others: once set, the connections
+    watching it are shut down, which wakes up whoever is reading them
+    """
+    def __init__(self):
+        self.conns = set()
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def isSet(self):
+        return self.cancelled
+
+    def set(self):
+        with self.lock:
+            self.cancelled = True
+            for conn in self.conns:
+                try:
+                    conn.sock.shutdown(socket.SHUT_RDWR)
+                except (AttributeError, socket.error):
+                    pass
+
+    def watch(self, conn):
+        with self.lock:
+            if self.cancelled:
+                raise socket.error('Cancelled')
+            self.conns.add(conn)
+
+    def unwatch(self, conn):
+        with self.lock:
+            self.conns.discard(conn)
+
+class ConnectionPool(object):
+    """
+    Keep-alive HTTP and HTTPS connections shared by every job, at most
+    maxPerHost to each host.  When they are all busy a request waits for
+    one to come back, or with block False opens an extra one that is
+    closed after use.
+    """
+    def __init__(self, maxPerHost, proxy=None, block=True):
+        self.maxPerHost = maxPerHost
+        self.proxy = proxy
+        self.block = block
+        self.idle = {}
+        self.open = {}
+        self.stats = {'new': 0, 'reused': 0, 'waited': 0, 'dropped': 0}
+        self.cond = threading.Condition()
+
+    def connect(self, key):
+        scheme, host, port = key
+        if self.proxy:
+            proxyHost, proxyPort = proxyAddress(self.proxy)
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(proxyHost, proxyPort, timeout=RequestTimeout)
+                conn.set_tunnel(host, port)
+                return conn
+            return httplib.HTTPConnection(proxyHost, proxyPort, timeout=RequestTimeout)
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, timeout=RequestTimeout)
+        return httplib.HTTPConnection(host, port, timeout=RequestTimeout)
+
+    def acquire(self, key):
+        """
+        Return (connection, True if it was used before)
+        """
+        conn = None
+        waitStart = None
+        with self.cond:
+            deadline = time.time() + RequestTimeout
+            while True:
+                if self.idle.get(key):
+                    self.stats['reused'] += 1
+                    conn = self.idle[key].pop()
+                    break
+                if self.open.get(key, 0) < self.maxPerHost or not self.block:
+                    self.open[key] = self.open.get(key, 0) + 1
+                    self.stats['new'] += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise FetchError('No connection to %s:%d available' % key[1:])
+                if waitStart is None:
+                    self.stats['waited'] += 1
+                    waitStart = time.time()
+                self.cond.wait(remaining)
+        if profiler and waitStart is not None:
+            profiler.record('connectionWait', None, waitStart)
+        if conn is not None:
+            return (conn, True)
+        return (self.connect(key), False)
+
+    def release(self, key, conn, reusable, cancel=None):
+        # Stop watching conn before another request can take it
+        if cancel is not None:
+            cancel.unwatch(conn)
+        with self.cond:
+            if reusable and self.open[key] <= self.maxPerHost:
+                self.idle.setdefault(key, []).append(conn)
+            else:
+                if reusable:
+                    self.stats['dropped'] += 1
+                conn.close()
+                self.open[key] -= 1
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            for key, conns in self.idle.items():
+                for conn in conns:
+                    conn.close()
+                self.open[key] -= len(conns)
+            self.idle = {}
+
+    def get(self, url, headers, fout=None, info=None, cancel=None):
+        """
+        Return the body of url, or with fout write it there ChunkSize bytes
+        at a time and return its length.  Follows redirections.  With info,
+        fills it with the response headers and returns None on a 304.
+        Setting cancel (a Cancellation) stops the download.
+        """
+        for redirect in range(MaxRedirects):
+            urlp = urlparse(url)
+            scheme = urlp.scheme or 'http'
+            key = (scheme, urlp.hostname, urlp.port or (443 if scheme == 'https' else 80))
+            if self.proxy and scheme == 'http':
+                path = url
+            else:
+                path = urlunparse(('', '', urlp.path or '/', urlp.params, urlp.query, ''))
+            while True:
+                conn, reused = self.acquire(key)
+                try:
+                    if cancel is not None:
+                        if conn.sock is None:
+                            conn.connect()
+                        cancel.watch(conn)
+                    conn.request('GET', path, headers=headers)
+                    response = conn.getresponse()
+                    break
+                except (httplib.HTTPException, socket.error), e:
+                    self.release(key, conn, False, cancel)
+                    if cancel is not None and cancel.isSet():
+                        raise FetchError('Cancelled: %s' % url)
+                    if not reused:
+                        raise FetchError('Error downloading: %s, %s' % (e, url))
+                    # Keep-alive connection closed by the server, take another
+
+            try:
+                if response.status in (301, 302, 303, 307, 308) and \
+                   response.getheader('location'):
+                    response.read()
+                    self.release(key, conn, not response.will_close, cancel)
+                    url = urljoin(url, response.getheader('location'))
+                    continue
+                if response.status == 304 and info is not None:
+                    response.read()
+                    self.release(key, conn, not response.will_close, cancel)
+                    info.update(response.getheaders())
+                    return None
+                if response.status != 200:
+                    response.read()
+                    self.release(key, conn, not response.will_close, cancel)
+                    raise FetchError('Error downloading: %s, %s' % (response.status, url),
+                                     response.status)
+                if fout is None and cancel is None:
+                    body = response.read()
+                else:
+                    chunks = []
+                    size = 0
+                    while True:
+                        chunk = response.read(ChunkSize)
+                        if not chunk or (cancel is not None and cancel.isSet()):
+                            break
+                        if fout is None:
+                            chunks.append(chunk)
+                        else:
+                            fout.write(chunk)
+                        size += len(chunk)
+                    if cancel is not None and cancel.isSet():
+                        self.release(key, conn, False, cancel)
+                        raise FetchError('Cancelled: %s' % url)
+                    body = size if fout is not None else ''.join(chunks)
+            except (httplib.HTTPException, socket.error), e:
+                self.release(key, conn, False, cancel)
+                if cancel is not None and cancel.isSet():
+                    raise FetchError('Cancelled: %s' % url)
+                raise FetchError('Error downloading: %s, %s' % (e, url))
+            finally:
+                if cancel is not None:
+                    cancel.unwatch(conn)
+            self.release(key, conn, not response.will_close, cancel)
+            if info is not None:
+                info.update(response.getheaders())
+            return body
+        raise FetchError('Too many redirections: %s' % url)
+
+def proxyAddress(proxy):
+    """
+    (host, port) of a proxy given as host or host:port
+    """
+    host, sep, port = proxy.rpartition(':')
+    if not sep or not port.isdigit():
+        return (proxy.strip('[]'), DefaultProxyPort)
+    return (host.strip('[]'), int(port))
+
+connectionPools = {}
+connectionPoolsLock = threading.Lock()
+
+def connectionPool(proxy=None):
+    """
+    The ConnectionPool shared by the jobs going through proxy, with a
+    connection per fetcher to each host and one for bootstrap refreshes
+    """
+    with connectionPoolsLock:
+        if proxy not in connectionPools:
+            maxPerHost = MaxHostConnections
+            if not maxPerHost:
+                maxPerHost = (MaxWorkerThreads if Adaptive else NumWorkerThreads or 1) + 1
+            connectionPools[proxy] = ConnectionPool(maxPerHost, proxy, not HostOverflow)
+        return connectionPools[proxy]
+
+class DocumentCache(object):
+    """
+    Manifests and bootstrap infos by url, keeping the maxEntries used
+    last, and with dirname every entry on disk for the next runs.  An
+    entry is used as is for ttl seconds, or less if the server says so,
+    then revalidated with its ETag or Last-Modified.
+    """
+    def __init__(self, maxEntries, dirname=None):
+        self.maxEntries = maxEntries
+        self.dirname = dirname
+        self.entries = collections.OrderedDict()
+        self.stats = {'hits': 0, 'revalidated': 0, 'misses': 0, 'loaded': 0}
+        self.lock = threading.Lock()
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+    def path(self, url):
+        return os.path.join(self.dirname, hashlib.sha1(url).hexdigest() + '.doc')
+
+    def load(self, url):
+        """
+        The entry an earlier run kept on disk for url, or None
+        """
+        if not self.dirname:
+            return None
+        try:
+            with open(self.path(url), "rb") as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+            if not isinstance(meta, dict) or meta.get('url') != url:
+                return None
+            return {
+                'body': body,
+                'fetched': meta['fetched'],
+                'expires': meta['expires'],
+                'etag': meta['etag'] and str(meta['etag']),
+                'modified': meta['modified'] and str(meta['modified']),
+            }
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def save(self, url, entry):
+        """
+        Write entry to disk, one file per url with a JSON line of its
+        metadata before the body, dropping the oldest files over
+        MaxCacheFiles
+        """
+        if not self.dirname:
+            return
+        meta = {'url': url, 'fetched': entry['fetched'], 'expires': entry['expires'],
+                'etag': entry['etag'], 'modified': entry['modified']}
+        try:
+            f = tempfile.NamedTemporaryFile(dir=self.dirname, suffix='.tmp', delete=False)
+            with f:
+                f.write(json.dumps(meta) + '\n')
+                f.write(entry['body'])
+            os.rename(f.name, self.path(url))
+            files = [os.path.join(self.dirname, name)
+                     for name in os.listdir(self.dirname) if name.endswith('.doc')]
+            if len(files) > MaxCacheFiles:
+                files.sort(key=os.path.getmtime)
+                for path in files[:len(files) - MaxCacheFiles]:
+                    os.remove(path)
+        except (IOError, OSError), e:
+            print 'Failed to cache document:', e
+
+    def lifetime(self, info, ttl):
+        for directive in info.get('cache-control', '').lower().split(','):
+            directive = directive.strip()
+            if directive in ('no-cache', 'no-store'):
+                return 0
+            if directive.startswith('max-age='):
+                try:
+                    return min(ttl, int(directive[8:]))
+                except ValueError:
+                    pass
+        return ttl
+
+    def get(self, url, fetch, ttl):
+        """
+        Return the body of url, calling fetch(url, headers=, info=) when
+        the entry is missing or stale
+        """
+        with self.lock:
+            entry = self.entries.pop(url, None)
+            if entry:
+                self.entries[url] = entry
+        if entry is None:
+            entry = self.load(url)
+            if entry:
+                with self.lock:
+                    self.stats['loaded'] += 1
+                    self.entries[url] = entry
+        # This run's ttl holds for the entries of the earlier ones too
+        if entry and min(entry['expires'], entry['fetched'] + ttl) > time.time():
+            with self.lock:
+                self.stats['hits'] += 1
+            return entry['body']
+
+        headers = {}
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry['modified']:
+            headers['If-Modified-Since'] = entry['modified']
+        info = {}
+        body = fetch(url, headers=headers, info=info)
+        with self.lock:
+            if body is None:
+                self.stats['revalidated'] += 1
+                body = entry['body']
+            else:
+                self.stats['misses'] += 1
+            if 'no-store' in info.get('cache-control', '').lower():
+                self.entries.pop(url, None)
+                if self.dirname and os.path.exists(self.path(url)):
+                    os.remove(self.path(url))
+                return body
+            entry = self.entries[url] = {
+                'body': body,
+                'fetched': time.time(),
+                'expires': time.time() + self.lifetime(info, ttl),
+                'etag': info.get('etag') or (entry and entry['etag']),
+                'modified': info.get('last-modified') or (entry and entry['modified']),
+            }
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+        self.save(url, entry)
+        return body
+
+    def expire(self, url):
+        """
+        Revalidate url every time from now on, as for the bootstrap info
+        of a live stream
+        """
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry:
+                entry['expires'] = 0
+        if entry:
+            self.save(url, entry)
+
+documentCache = DocumentCache(MaxCacheEntries)
+
+class FragmentCache(object):
+    """
+    Fragments kept in dirname by url, for the jobs of this run and of
+    the next ones, up to maxSize bytes.  The ones used least recently
+    go first, and a file that no longer holds a complete fragment is
+    dropped when read.
+    """
+    def __init__(self, dirname, maxSize):
+        self.dirname = dirname
+        self.maxSize = maxSize
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.stats = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0, 'corrupt': 0}
+        self.lock = threading.Lock()
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        # Files are touched when used, so their mtime is the LRU order
+        files = []
+        for name in os.listdir(dirname):
+            if name.endswith('.frag'):
+                st = os.stat(os.path.join(dirname, name))
+                files.append((st.st_mtime, name, st.st_size))
+        for mtime, name, size in sorted(files):
+            self.entries[name] = size
+            self.size += size
+        with self.lock:
+            self.evict()
+
+    def name(self, url):
+        return hashlib.sha1(url).hexdigest() + '.frag'
+
+    def drop(self, name):
+        # Called with the lock held
+        self.size -= self.entries.pop(name, 0)
+        try:
+            os.remove(os.path.join(self.dirname, name))
+        except OSError:
+            pass
+
+    def evict(self):
+        # Called with the lock held
+        while self.size > self.maxSize and self.entries:
+            self.drop(next(iter(self.entries)))
+            self.stats['evicted'] += 1
+
+    def load(self, job, item):
+        """
+        Set item.data from the cache, mapped with --stream, and decode it
+        with prepareFragment.  Returns whether it was there and complete.
+        """
+        name = self.name(item.url)
+        path = os.path.join(self.dirname, name)
+        with self.lock:
+            if name not in self.entries:
+                self.stats['misses'] += 1
+                return False
+            self.entries[name] = self.entries.pop(name)
+        try:
+            f = open(path, "rb")
+            if Streaming:
+                item.release()
+                item.spool = f
+                f.seek(0, 2)
+                item.mapSpool()
+            else:
+                item.data = f.read()
+                f.close()
+            prepareFragment(job, item)
+            valid = item.info is not None
+            os.utime(path, None)
+        except (IOError, OSError, struct.error):
+            valid = False
+        with self.lock:
+            if not valid:
+                print 'Cached fragment', item.fragNum, 'is incomplete, downloading it again'
+                item.release()
+                self.drop(name)
+                self.stats['corrupt'] += 1
+                self.stats['misses'] += 1
+                return False
+            self.stats['hits'] += 1
+        return True
+
+    def store(self, url, data):
+        """
+        Keep a downloaded fragment, once prepareFragment found it complete
+        """
+        name = self.name(url)
+        try:
+            f = tempfile.NamedTemporaryFile(dir=self.dirname, suffix='.tmp', delete=False)
+            with f:
+                f.write(data)
+            os.rename(f.name, os.path.join(self.dirname, name))
+        except (IOError, OSError), e:
+            print 'Failed to cache fragment:', e
+            return
+        with self.lock:
+            self.size -= self.entries.pop(name, 0)
+            self.entries[name] = len(data)
+            self.size += len(data)
+            self.stats['stored'] += 1
+            self.evict()
+
+class JobMetrics(object):
+    """
+    Counters of a download, updated by the fetchers and the writer
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.fetched = 0
+        self.written = 0
+        self.retried = 0
+        self.hedged = 0
+        self.hedgesWon = 0
+        self.bytesFetched = 0
+        self.bytesWritten = 0
+        self.latencySum = 0.0
+        self.latencyCounts = [0] * (len(LatencyBuckets) + 1)
+        self.lock = threading.Lock()
+
+    def recordFetch(self, latency, size):
+        with self.lock:
+            self.fetched += 1
+            self.bytesFetched += size
+            self.latencySum += latency
+            for i, bound in enumerate(LatencyBuckets):
+                if latency <= bound:
+                    break
+            else:
+                i = len(LatencyBuckets)
+            self.latencyCounts[i] += 1
+
+    def recordRetry(self):
+        with self.lock:
+            self.retried += 1
+
+    def recordHedge(self, won=False):
+        with self.lock:
+            if won:
+                self.hedgesWon += 1
+            else:
+                self.hedged += 1
+
+    def recordWrite(self, size):
+        with self.lock:
+            self.written += 1
+            self.bytesWritten += size
+
+    def snapshot(self, job):
+        with self.lock:
+            elapsed = max(time.time() - self.start, 0.001)
+            infos = {
+                'fragmentsFetched': self.fetched,
+                'fragmentsWritten': self.written,
+                'fragmentsRetried': self.retried,
+                'fragmentsHedged': self.hedged,
+                'hedgesWon': self.hedgesWon,
+                'bytesFetched': self.bytesFetched,
+                'bytesWritten': self.bytesWritten,
+                'bytesPerSecond': self.bytesFetched / elapsed,
+                'elapsed': elapsed,
+                'latencySum': self.latencySum,
+                'latencyBuckets': zip(LatencyBuckets + ('+Inf',), self.latencyCounts),
+            }
+        buf = getattr(job, 'queueUrlDone', None)
+        if buf is not None:
+            infos['reorderDepth'] = len(buf.items)
+            infos['reorderBytes'] = buf.size
+            infos['writerIdle'] = buf.waitTime
+        left = job.nbFragments - job.resumeFrag + 1 - infos['fragmentsWritten']
+        if infos['fragmentsWritten'] and not job.following:
+            infos['eta'] = left * elapsed / infos['fragmentsWritten']
+        else:
+            infos['eta'] = None
+        return infos
+
+class Profiler(object):
+    """
+    Times what happens to every fragment: waiting in queueUrl (queue),
+    the download (fetch), parsing (decode), waiting in queueUrlDone
+    (reorder) and writing (write), and how long the fetchers, the writer
+    and the connections wait on each other (fetcherIdle, writerIdle,
+    connectionWait, poolLock, reorderLock).  Each span is passed to the
+    hooks as hook(stage, item, start, end), item being None for the
+    waits.  The summary counts every span, the trace keeps the last
+    MaxProfileSpans.
+    """
+    # Spans of a fragment that cross threads or overlap on one
+    FragmentStages = ('queue', 'fetch', 'reorder')
+
+    def __init__(self):
+        self.start = time.time()
+        self.hooks = []
+        self.spans = collections.deque(maxlen=MaxProfileSpans)
+        self.dropped = 0
+        self.totals = {}
+        self.threadNames = {}
+        self.lock = threading.Lock()
+
+    def addHook(self, hook):
+        with self.lock:
+            self.hooks.append(hook)
+
+    def removeHook(self, hook):
+        with self.lock:
+            if hook in self.hooks:
+                self.hooks.remove(hook)
+
+    def record(self, stage, item, start, end=None):
+        if end is None:
+            end = time.time()
+        thread = threading.current_thread()
+        with self.lock:
+            self.threadNames[thread.ident] = thread.name
+            if len(self.spans) == self.spans.maxlen:
+                self.dropped += 1
+            self.spans.append((stage, item and (item.chunkNum, item.fragNum),
+                               start, end, thread.ident))
+            total = self.totals.setdefault(stage, [0, 0.0, 0.0])
+            total[0] += 1
+            total[1] += end - start
+            total[2] = max(total[2], end - start)
+            hooks = list(self.hooks)
+        for hook in hooks:
+            hook(stage, item, start, end)
+
+    def summary(self):
+        """
+        Count, total, mean and longest time of each stage, in seconds
+        """
+        with self.lock:
+            return dict((stage, {'count': count, 'total': total,
+                                 'mean': total / count, 'max': longest})
+                        for stage, (count, total, longest) in self.totals.items())
+
+    def printSummary(self):
+        summary = self.summary()
+        print '%-16s %8s %10s %10s %10s' % ('stage', 'count', 'total s', 'mean ms', 'max ms')
+        for stage in sorted(summary, key=lambda s: -summary[s]['total']):
+            times = summary[stage]
+            print '%-16s %8d %10.3f %10.2f %10.2f' % (stage, times['count'], times['total'],
+                                                     times['mean'] * 1000, times['max'] * 1000)
+
+    def traceEvents(self):
+        """
+        The spans as Chrome trace events (chrome://tracing, Perfetto):
+        the stages of each fragment as async events, the rest as complete
+        events on the thread they ran on
+        """
+        pid = os.getpid()
+        with self.lock:
+            spans = list(self.spans)
+            threadNames = dict(self.threadNames)
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                   'args': {'name': name}} for tid, name in threadNames.items()]
+        for stage, fragment, start, end, tid in spans:
+            ts = (start - self.start) * 1e6
+            dur = (end - start) * 1e6
+            event = {'name': stage, 'pid': pid, 'tid': tid, 'ts': ts}
+            if fragment:
+                event['args'] = {'job': fragment[0], 'fragment': fragment[1]}
+            if fragment and stage in self.FragmentStages:
+                event['cat'] = 'fragment'
+                event['id'] = '%d.%d' % fragment
+                events.append(dict(event, ph='b'))
+                events.append(dict(event, ph='e', ts=ts + dur))
             else:
-                M6Item.videoFragment(item.chunkNum, item.fragNum, item.data, outFile)
+                event['cat'] = 'stage' if fragment else 'wait'
+                event['ph'] = 'X'
+                event['dur'] = dur
+                events.append(event)
+        return events
+
+    def dumpTrace(self, filename):
+        with open(filename, "w") as f:
+            json.dump({'traceEvents': self.traceEvents(),
+                       'displayTimeUnit': 'ms',
+                       'otherData': {'droppedSpans': self.dropped}}, f)
+
+def addProfileHook(hook):
+    """
+    Call hook(stage, item, start, end) for every span timed from now on,
+    starting the profiler if --profile did not
+    """
+    global profiler
+    if profiler is None:
+        profiler = Profiler()
+    profiler.addHook(hook)
+    return profiler
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    /metrics in the Prometheus text format, / as JSON
+    """
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        # Only the jobs already downloading
+        jobs = [job for job in self.server.scheduler.jobs
+                if getattr(job, 'queueUrlDone', None) is not None]
+        if self.path == '/metrics':
+            body = prometheusText(jobs)
+            contentType = 'text/plain; version=0.0.4'
+        elif self.path == '/':
+            body = json.dumps([job.getInfos() for job in jobs])
+            contentType = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, scheduler):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), MetricsHandler)
+        self.scheduler = scheduler
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+
+def prometheusText(jobs):
+    metrics = [
+        ('fragments_fetched_total', 'counter', 'Fragments downloaded', 'fragmentsFetched'),
+        ('fragments_written_total', 'counter', 'Fragments written', 'fragmentsWritten'),
+        ('fragments_retried_total', 'counter', 'Fragment downloads retried', 'fragmentsRetried'),
+        ('fragments_hedged_total', 'counter', 'Second requests sent for late fragments', 'fragmentsHedged'),
+        ('hedges_won_total', 'counter', 'Second requests that arrived first', 'hedgesWon'),
+        ('fetched_bytes_total', 'counter', 'Bytes downloaded', 'bytesFetched'),
+        ('written_bytes_total', 'counter', 'Payload bytes written', 'bytesWritten'),
+        ('bytes_per_second', 'gauge', 'Average download rate', 'bytesPerSecond'),
+        ('reorder_depth', 'gauge', 'Fragments waiting for the writer', 'reorderDepth'),
+        ('reorder_bytes', 'gauge', 'Bytes waiting for the writer', 'reorderBytes'),
+        ('writer_idle_seconds_total', 'counter', 'Time the writer waited for fragments', 'writerIdle'),
+        ('eta_seconds', 'gauge', 'Estimated time left', 'eta'),
+    ]
+    snapshots = [('job="%d",file="%s"' % (job.chunkNum, os.path.basename(job.localfilename)),
+                  job.metrics.snapshot(job)) for job in jobs]
+    lines = []
+    for name, metricType, description, key in metrics:
+        lines.append('# HELP adobehds_%s %s' % (name, description))
+        lines.append('# TYPE adobehds_%s %s' % (name, metricType))
+        for labels, infos in snapshots:
+            if infos.get(key) is not None:
+                lines.append('adobehds_%s{%s} %s' % (name, labels, infos[key]))
+    lines.append('# HELP adobehds_fetch_latency_seconds Fragment download time')
+    lines.append('# TYPE adobehds_fetch_latency_seconds histogram')
+    for labels, infos in snapshots:
+        count = 0
+        for bound, n in infos['latencyBuckets']:
+            count += n
+            lines.append('adobehds_fetch_latency_seconds_bucket{%s,le="%s"} %d' % (labels, bound, count))
+        lines.append('adobehds_fetch_latency_seconds_sum{%s} %s' % (labels, infos['latencySum']))
+        lines.append('adobehds_fetch_latency_seconds_count{%s} %d' % (labels, count))
+    lines.append('# HELP adobehds_document_cache_total Manifest and bootstrap lookups')
+    lines.append('# TYPE adobehds_document_cache_total counter')
+    for result in ('hits', 'revalidated', 'misses'):
+        lines.append('adobehds_document_cache_total{result="%s"} %d' % (
+            result, documentCache.stats[result]))
+    if fragmentCache is not None:
+        lines.append('# HELP adobehds_fragment_cache_total Fragment cache lookups and updates')
+        lines.append('# TYPE adobehds_fragment_cache_total counter')
+        for event in ('hits', 'misses', 'stored', 'evicted', 'corrupt'):
+            lines.append('adobehds_fragment_cache_total{event="%s"} %d' % (
+                event, fragmentCache.stats[event]))
+        lines.append('# HELP adobehds_fragment_cache_bytes Size of the fragment cache')
+        lines.append('# TYPE adobehds_fragment_cache_bytes gauge')
+        lines.append('adobehds_fragment_cache_bytes %d' % fragmentCache.size)
+    lines.append('# HELP adobehds_http_connections_total Connections opened or reused')
+    lines.append('# TYPE adobehds_http_connections_total counter')
+    for proxy, pool in connectionPools.items():
+        for kind in ('new', 'reused', 'waited', 'dropped'):
+            lines.append('adobehds_http_connections_total{proxy="%s",kind="%s"} %d' % (
+                proxy or '', kind, pool.stats[kind]))
+    return '\n'.join(lines) + '\n'
+
+class FetchPool(object):
+    """
+    Worker threads shared by all the jobs downloading at the same time.
+    Each thread takes the next fragment from the jobs in turn, so that
+    NumWorkerThreads is a limit on the whole process.
+    """
+    def __init__(self, numThreads, controller=None):
+        self.numThreads = numThreads
+        self.controller = controller
+        if controller:
+            self.numThreads = controller.maxLimit
+        self.jobs = []
+        self.threads = []
+        self.active = 0
+        self.closed = False
+        self.retries = RetryScheduler()
+        self.breaker = CircuitBreaker()
+        self.inFlight = {}
+        self.latencies = collections.deque(maxlen=HedgeSamples)
+        self.cond = threading.Condition()
+
+    def add(self, job):
+        with self.cond:
+            self.jobs.append(job)
+            while len(self.threads) < self.numThreads:
+                t = threading.Thread(target=self.worker)
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+            self.cond.notify_all()
+
+    def remove(self, job):
+        with self.cond:
+            if job in self.jobs:
+                self.jobs.remove(job)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join()
+        self.retries.close()
+
+    def nextFragment(self):
+        st = time.time()
+        spans = []
+        try:
+            with self.cond:
+                spans.append(('poolLock', None, st, time.time()))
+                return self.takeFragment(spans)
+        finally:
+            if profiler:
+                for span in spans:
+                    profiler.record(*span)
+
+    def takeFragment(self, spans):
+        """
+        Pick the next fragment to fetch with self.cond held, appending the
+        profiler spans to record once the lock is released
+        """
+        while not self.closed:
+            if self.controller and self.active >= self.controller.limit:
+                self.cond.wait(0.1)
+                continue
+            for i in range(len(self.jobs)):
+                job = self.jobs.pop(0)
+                self.jobs.append(job)
+                if job.status != 'DOWNLOADING' or job.queueUrl.empty() or \
+                   not job.queueUrlDone.waitForRoom(0):
+                    continue
+                try:
+                    item = job.queueUrl.get(False)[1]
+                except Queue.Empty:
+                    continue
+                spans.append(('queue', item, item.queued, time.time()))
+                job.queueUrlDone.startFetch(item.fragNum)
+                wait = self.breaker.blockedFor(urlparse(item.url).netloc)
+                if wait:
+                    self.retries.schedule(job, item, wait)
+                    continue
+                self.active += 1
+                return (job, item)
+            hedge = hedgeCandidate(self.inFlight, self.latencies)
+            if hedge:
+                self.active += 1
+                return hedge
+            idle = time.time()
+            self.cond.wait(0.1)
+            spans.append(('fetcherIdle', None, idle, time.time()))
+        return (None, None)
+
+    def worker(self):
+        while True:
+            job, item = self.nextFragment()
+            if job is None:
+                return
+            st = time.time()
+            with self.cond:
+                self.inFlight[item] = (job, st)
+            # A duplicate request was not taken from the queue
+            duplicate = item.duplicate
+            lost = False
+            try:
+                cached = fragmentCache is not None and fragmentCache.load(job, item)
+                if not cached:
+                    # Lets a hedge for this fragment interrupt the request
+                    if Hedging and item.cancel is None:
+                        item.cancel = Cancellation()
+                    if Streaming:
+                        job.getFile(item.url, item.openSpool(job.spoolDir), cancel=item.cancel)
+                        item.mapSpool()
+                    else:
+                        item.data = job.getFile(item.url, cancel=item.cancel)
+                    if self.controller:
+                        self.controller.record(time.time() - st, len(item.data))
+                    job.metrics.recordFetch(time.time() - st, len(item.data))
+                    self.latencies.append(time.time() - st)
+                    if profiler:
+                        profiler.record('fetch', item, st)
+                    self.breaker.success(urlparse(item.url).netloc)
+                    if item.hedge is not None and not item.hedge.claim(item):
+                        # The other request got there first
+                        item.release()
+                        lost = True
+                if not lost:
+                    if duplicate:
+                        job.metrics.recordHedge(won=True)
+                    if not cached:
+                        prepareFragment(job, item)
+                        if fragmentCache is not None and item.info is not None:
+                            fragmentCache.store(item.url, item.data)
+                    storeFragment(job, item)
+            except FetchError, e:
+                if not hedgeFailed(item):
+                    if self.controller:
+                        self.controller.record(time.time() - st, 0, ok=False)
+                    retryFragment(self, job, item, e)
+            except Exception as e:
+                failJob(job, str(e))
+            with self.cond:
+                self.inFlight.pop(item, None)
+                self.active -= 1
+                self.cond.notify_all()
+            if not duplicate:
+                job.queueUrl.task_done()
+
+class AsyncHttpConnection(asyncore.dispatcher):
+    """
+    Non-blocking keep-alive HTTP/1.1 connection of an AsyncFetcher,
+    carrying one request at a time
+    """
+    def __init__(self, fetcher, address):
+        asyncore.dispatcher.__init__(self, map=fetcher.map)
+        self.fetcher = fetcher
+        self.address = address
+        self.job = None
+        self.item = None
+        self.outbuf = ''
+        self.requests = 0
+        self.lastActivity = time.time()
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+
+    def request(self, job, item, url, host, path, redirects=0):
+        self.job = job
+        self.item = item
+        self.url = url
+        self.redirects = redirects
+        self.outbuf = ('GET %s HTTP/1.1\r\n'
+                       'Host: %s\r\n'
+                       'User-Agent: %s\r\n'
+                       'Connection: keep-alive\r\n\r\n' % (path, host, UserAgent))
+        self.header = ''
+        self.status = None
+        self.location = None
+        self.length = None
+        self.chunked = False
+        self.chunkLeft = None
+        self.raw = ''
+        self.keepAlive = True
+        self.body = []
+        self.received = 0
+        self.spool = None
+        if Streaming:
+            self.spool = item.openSpool(job.spoolDir)
+        self.requests += 1
+        self.started = self.lastActivity = time.time()
+
+    def parseHeader(self, header):
+        lines = header.split('\r\n')
+        version, status = lines[0].split(' ', 2)[:2]
+        self.status = int(status)
+        self.keepAlive = version == 'HTTP/1.1'
+        for line in lines[1:]:
+            name, value = line.split(':', 1)
+            name = name.strip().lower()
+            value = value.strip()
+            if name == 'content-length':
+                self.length = int(value)
+            elif name == 'transfer-encoding':
+                self.chunked = value.lower() == 'chunked'
+            elif name == 'connection':
+                value = value.lower()
+                self.keepAlive = value == 'keep-alive' or \
+                                 (self.keepAlive and value != 'close')
+            elif name == 'location':
+                self.location = value
+
+    def store(self, data):
+        if self.spool is not None:
+            self.spool.write(data)
+        else:
+            self.body.append(data)
+
+    def feed(self, data):
+        if self.chunked:
+            self.feedChunked(data)
+            return
+        if self.length is not None:
+            data = data[:self.length - self.received]
+        self.store(data)
+        self.received += len(data)
+        if self.length is not None and self.received >= self.length:
+            self.finish()
+
+    def feedChunked(self, data):
+        self.raw += data
+        while True:
+            if self.chunkLeft is None:
+                eol = self.raw.find('\r\n')
+                if eol < 0:
+                    return
+                self.chunkLeft = int(self.raw[:eol].split(';')[0], 16)
+                self.raw = self.raw[eol + 2:]
+            if self.chunkLeft == 0:
+                # Wait for the end of the (ignored) trailers
+                if self.raw.startswith('\r\n') or '\r\n\r\n' in self.raw:
+                    self.finish()
+                return
+            if len(self.raw) < self.chunkLeft + 2:
+                return
+            self.store(self.raw[:self.chunkLeft])
+            self.raw = self.raw[self.chunkLeft + 2:]
+            self.chunkLeft = None
+
+    def finish(self):
+        item = self.item
+        self.item = None
+        if not self.keepAlive:
+            self.close()
+        if self.spool is not None:
+            item.mapSpool()
+        else:
+            item.data = ''.join(self.body)
+        self.body = []
+        self.fetcher.done(self, self.job, item, self.status)
+
+    def writable(self):
+        return not self.connected or bool(self.outbuf)
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self.outbuf)
+        self.outbuf = self.outbuf[sent:]
+
+    def handle_read(self):
+        data = self.recv(262144)
+        if not data:
+            return
+        self.lastActivity = time.time()
+        if self.item is None:
+            # Nothing was asked on this connection
+            self.close()
+            return
+        if self.status is None:
+            self.header += data
+            end = self.header.find('\r\n\r\n')
+            if end < 0:
+                return
+            data = self.header[end + 4:]
+            self.parseHeader(self.header[:end])
+            if self.length == 0:
+                self.finish()
+                return
+        self.feed(data)
+
+    def handle_close(self):
+        self.close()
+        if self.item is not None:
+            item = self.item
+            self.item = None
+            if self.status is not None and self.length is None and not self.chunked:
+                # Body delimited by the end of the connection
+                self.item = item
+                self.finish()
+            elif self.requests > 1 and self.status is None and not self.header:
+                # Keep-alive connection closed by the server before we used it
+                self.fetcher.failed(self, self.job, item, None)
+            else:
+                self.fetcher.failed(self, self.job, item, FetchError('Connection closed'))
+        else:
+            self.fetcher.closedConnection(self)
+
+    def handle_error(self):
+        error = FetchError(str(sys.exc_info()[1]))
+        self.close()
+        if self.item is not None:
+            item = self.item
+            self.item = None
+            self.fetcher.failed(self, self.job, item, error)
+        else:
+            self.fetcher.closedConnection(self)
+
+class AsyncFetcher(object):
+    """
+    Downloads the queued fragments of all the jobs from a single thread
+    with an asyncore event loop, keeping up to maxConnections requests in
+    flight over keep-alive connections.  Fragments go to the same
+    ReorderBuffer as with the worker threads.  Host names are resolved on
+    a thread of their own, the requests to a host waiting in pending until
+    its address is known.  Jobs it cannot fetch (https) share one pool of
+    worker threads, started by threadPool.
+    """
+    def __init__(self, maxConnections, proxy=None, controller=None):
+        self.maxConnections = maxConnections
+        self.proxy = proxy
+        self.controller = controller
+        self.map = {}
+        self.idle = {}
+        self.busy = set()
+        self.jobs = []
+        self.thread = None
+        self.closed = False
+        self.retries = RetryScheduler()
+        self.breaker = CircuitBreaker()
+        self.latencies = collections.deque(maxlen=HedgeSamples)
+        self.addresses = {}
+        self.pending = {}
+        self.waiting = 0
+        self.resolved = Queue.Queue()
+        self.fallback = None
+        self.lock = threading.Lock()
+
+    def add(self, job):
+        with self.lock:
+            self.jobs.append(job)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def remove(self, job):
+        with self.lock:
+            if job in self.jobs:
+                self.jobs.remove(job)
+
+    def threadPool(self):
+        with self.lock:
+            if self.fallback is None:
+                self.fallback = newFetchPool(self.proxy, 'threads')
+            return self.fallback
+
+    def close(self):
+        self.closed = True
+        if self.thread:
+            self.thread.join()
+        self.retries.close()
+        if self.fallback is not None:
+            self.fallback.close()
+
+    def getConnection(self, address):
+        if self.idle.get(address):
+            return self.idle[address].pop()
+        if len(self.map) >= self.maxConnections:
+            # Make room by closing an idle connection to another host
+            for conns in self.idle.values():
+                if conns:
+                    conns.pop().close()
+                    break
+        return AsyncHttpConnection(self, address)
+
+    def schedule(self):
+        with self.lock:
+            jobs = [job for job in self.jobs if job.status == 'DOWNLOADING']
+        limit = self.maxConnections
+        if self.controller:
+            limit = self.controller.limit
+        # Take one fragment from each job in turn
+        while jobs and len(self.busy) + self.waiting < limit:
+            job = jobs.pop(0)
+            if job.queueUrl.empty() or not job.queueUrlDone.waitForRoom(0):
+                continue
+            try:
+                item = job.queueUrl.get(False)[1]
+            except Queue.Empty:
+                continue
+            if profiler:
+                profiler.record('queue', item, item.queued)
+            jobs.append(job)
+            urlp = urlparse(item.url)
+            job.queueUrlDone.startFetch(item.fragNum)
+            try:
+                cached = fragmentCache is not None and fragmentCache.load(job, item)
+                if cached:
+                    storeFragment(job, item)
+            except Exception as e:
+                failJob(job, str(e))
+                cached = True
+            if cached:
+                job.queueUrl.task_done()
+                continue
+            wait = self.breaker.blockedFor(urlp.netloc)
+            if wait:
+                self.retries.schedule(job, item, wait)
+                continue
+            self.send(job, item)
+        if len(self.busy) + self.waiting < limit:
+            inFlight = dict((conn.item, (conn.job, conn.started))
+                            for conn in self.busy if conn.item is not None)
+            hedge = hedgeCandidate(inFlight, self.latencies)
+            if hedge:
+                self.send(*hedge)
+
+    def send(self, job, item, url=None, redirects=0):
+        url = url or item.url
+        urlp = urlparse(url)
+        if self.proxy:
+            host, port = proxyAddress(self.proxy)
+            path = url
+        else:
+            host, port = urlp.hostname, urlp.port or 80
+            path = urlunparse(('', '', urlp.path or '/', urlp.params, urlp.query, ''))
+        address = self.addresses.get(host)
+        if address is None or address[1] < time.time():
+            self.waiting += 1
+            self.pending.setdefault(host, []).append((job, item, url, redirects))
+            if len(self.pending[host]) == 1:
+                t = threading.Thread(target=self.resolve, args=(host,))
+                t.daemon = True
+                t.start()
+            return
+        conn = self.getConnection((address[0], port))
+        conn.request(job, item, url, urlp.netloc, path, redirects)
+        self.busy.add(conn)
+
+    def resolve(self, host):
+        # On its own thread, the lookup blocks
+        try:
+            self.resolved.put((host, socket.gethostbyname(host), None))
+        except socket.error, e:
+            self.resolved.put((host, None, e))
+
+    def sendResolved(self, timeout=0):
+        """
+        Send the requests waiting for the hosts resolved so far, waiting up
+        to timeout seconds for one
+        """
+        try:
+            result = self.resolved.get(timeout > 0, timeout or None)
+            while True:
+                host, address, error = result
+                if address is not None:
+                    self.addresses[host] = (address, time.time() + DnsCacheTTL)
+                for job, item, url, redirects in self.pending.pop(host, []):
+                    self.waiting -= 1
+                    if address is not None:
+                        self.send(job, item, url, redirects)
+                    else:
+                        self.failed(None, job, item,
+                                    FetchError('Cannot resolve %s: %s' % (host, error)))
+                result = self.resolved.get(False)
+        except Queue.Empty:
+            pass
+
+    def cancel(self, winner):
+        """
+        Drop the other request for the hedged fragment winner
+        """
+        for conn in list(self.busy):
+            item = conn.item
+            if item is not None and item is not winner and item.hedge is winner.hedge:
+                conn.item = None
+                conn.close()
+                self.busy.discard(conn)
+                item.release()
+                if not item.duplicate:
+                    conn.job.queueUrl.task_done()
+
+    def done(self, conn, job, item, status):
+        self.busy.discard(conn)
+        if conn.connected and conn.keepAlive:
+            self.idle.setdefault(conn.address, []).append(conn)
+        if status in (301, 302, 303, 307, 308) and conn.location:
+            if conn.redirects + 1 < MaxRedirects:
+                item.release()
+                self.send(job, item, urljoin(conn.url, conn.location), conn.redirects + 1)
+                return
+            self.failed(conn, job, item, FetchError('Too many redirections: %s' % item.url))
+            return
+        if status != 200:
+            self.failed(conn, job, item, FetchError(
+                'Error downloading: %s, %s' % (status, item.url), status))
+            return
+        if self.controller:
+            self.controller.record(time.time() - conn.started, len(item.data))
+        job.metrics.recordFetch(time.time() - conn.started, len(item.data))
+        self.latencies.append(time.time() - conn.started)
+        if profiler:
+            profiler.record('fetch', item, conn.started)
+        self.breaker.success(urlparse(item.url).netloc)
+        if item.hedge is not None and item.hedge.claim(item):
+            self.cancel(item)
+            if item.duplicate:
+                job.metrics.recordHedge(won=True)
+        try:
+            prepareFragment(job, item)
+            if fragmentCache is not None and item.info is not None:
+                fragmentCache.store(item.url, item.data)
+            storeFragment(job, item)
+        except Exception as e:
+            failJob(job, str(e))
+        # A duplicate request was not taken from the queue
+        if not item.duplicate:
+            job.queueUrl.task_done()
+
+    def failed(self, conn, job, item, error):
+        self.busy.discard(conn)
+        duplicate = item.duplicate
+        if not hedgeFailed(item):
+            if error is None:
+                job.queueUrlDone.cancelFetch(item.fragNum)
+                item.queued = time.time()
+                job.queueUrl.put((item.fragNum, item))
+            else:
+                if self.controller and conn is not None:
+                    self.controller.record(time.time() - conn.started, 0, ok=False)
+                retryFragment(self, job, item, error)
+        if not duplicate:
+            job.queueUrl.task_done()
+
+    def closedConnection(self, conn):
+        conns = self.idle.get(conn.address, [])
+        if conn in conns:
+            conns.remove(conn)
+
+    def checkTimeouts(self):
+        now = time.time()
+        for conn in list(self.busy):
+            if now - conn.lastActivity > RequestTimeout:
+                job, item = conn.job, conn.item
+                conn.item = None
+                conn.close()
+                self.failed(conn, job, item, FetchError('Timed out'))
+            elif conn.job.status != 'DOWNLOADING':
+                # Drop the requests of a job that stopped
+                conn.item = None
+                conn.close()
+                self.busy.discard(conn)
+
+    def run(self):
+        try:
+            while not self.closed:
+                self.sendResolved()
+                self.schedule()
+                if self.busy:
+                    asyncore.loop(timeout=0.1, map=self.map, count=1)
+                    self.checkTimeouts()
+                else:
+                    self.sendResolved(0.1)
+        finally:
+            asyncore.close_all(map=self.map)
+
+def newFetchPool(proxy=None, engine=None):
+    if (engine or Engine) == 'async':
+        controller = None
+        if Adaptive:
+            controller = ConcurrencyController(NumWorkerThreads, MaxConnections)
+        return AsyncFetcher(MaxConnections, proxy, controller)
+    controller = None
+    if Adaptive:
+        controller = ConcurrencyController(NumWorkerThreads, MaxWorkerThreads)
+    return FetchPool(NumWorkerThreads, controller)
+
+def writeFragment(job, item, outFile):
+    """
+    Write a decoded fragment and journal it.  Returns False when the
+    timestamp fixer dropped it.
+    """
+    patches = []
+    tags = None
+    if job.flvFixer and not job.output:
+        start = item.info.payloadStart
+        tags = [(offset - start, 11 + size + 4)
+                for offset, packetType, size, ts in item.info.tags if offset >= start]
+    elif job.fixer:
+        start = item.info.payloadStart
+        patches = job.fixer.fix(item.fragNum,
+                                [tag for tag in item.info.tags if tag[0] >= start])
+        if patches is None:
+            # Journaled with no length, so a resume carries on after it
+            job.journal.append(item.fragNum, outFile.tell(), 0, 0, job.fixer.state())
+            return False
+        patches = [(offset - start, ts) for offset, ts in patches]
+    start = outFile.tell()
+    crc = job.videoFragment(item.chunkNum, item.fragNum, item.payload, outFile, patches, tags)
+    outFile.flush()
+    length = len(item.payload)
+    if tags is not None:
+        # Less the tags FlvFixer dropped
+        length = outFile.tell() - start
+        if item.fragNum == 1:
+            length -= job.bootstrapSize()
+    fixer = job.fixer or job.flvFixer
+    job.journal.append(item.fragNum, outFile.tell() - length,
+                       length, crc if crc is not None else item.crc,
+                       fixer.state() if fixer else ())
+    return True
+
+def finishOutput(job, nbFragments):
+    fixer = job.fixer
+    if job.output:
+        job.output.finish(job.localfilename, nbFragments, job.fixer)
+        if job.flvFixer:
+            # The fragments were not written in order, repair the file once
+            # they are
+            fixedFilename = job.localfilename + '.fixed'
+            fixer = FlvFixer.fixFile(job.localfilename, fixedFilename, FixWindow, quiet=True)
+            os.rename(fixedFilename, job.localfilename)
+    elif job.flvFixer:
+        fixer = job.flvFixer
+        with open(job.localfilename, "r+b") as f:
+            f.write(fixer.header())
+    if fixer and fixer.lastTS is not None:
+        job.writeDuration(job.localfilename, fixer.lastTS / 1000.0)
+
+def workerqdRun(job):
+    currentFrag = job.resumeFrag
+    outFile = None
+    if job.output is not None:
+        # --positional: the fetchers already wrote the fragments
+        pass
+    elif currentFrag > 1:
+        print 'Resuming at fragment', currentFrag
+        outFile = open(job.localfilename, "r+b")
+        outFile.seek(job.resumeOffset)
+        outFile.truncate()
+        fixer = job.fixer or job.flvFixer
+        if fixer:
+            fixer.resume(lastTimestamps(outFile, job.resumeOffset), job.journal.state)
+            outFile.seek(job.resumeOffset)
+    else:
+        outFile = open(job.localfilename, "wb")
+    lastWritten = None
+    # Check following first, nbFragments does not grow once it is off
+    while (job.following or currentFrag <= job.nbFragments) and \
+          job.status == 'DOWNLOADING':
+        for item in job.queueUrlDone.getRun():
+            if item.info is None:
+                job.status = 'FINISHED'
+                break
+            written = True
+            if outFile:
+                st = time.time()
+                written = writeFragment(job, item, outFile)
+                if profiler:
+                    profiler.record('write', item, st)
+            if written:
+                job.metrics.recordWrite(len(item.payload) if item.payload is not None
+                                        else item.info.mdatEnd - item.info.payloadStart)
                 print 'Fragment', currentFrag, 'OK'
-                currentFrag += 1  
-        elif currChunknum == item.chunkNum:
-            print 'Requeue', item.fragNum
-            QueueUrlDone.put((item.fragNum, item))
-            requeue = True
-        QueueUrlDone.task_done()
-        if requeue:
-            time.sleep(1)
-    outFile.close()
+                lastWritten = item.fragNum
+            item.release()
+            currentFrag += 1
+    if outFile:
+        outFile.close()
+    if job.liveEnded and lastWritten is not None:
+        # The number of the fragment in the stream, not its index in the job
+        print 'Live stream ended at fragment', job.fragments[lastWritten - 1][1]
     # If we have exited the previous loop with error
-    if currentFrag > M6Item.nbFragments:
-        M6Item.status = 'COMPLETED'
+    if currentFrag > job.nbFragments:
+        finishOutput(job, currentFrag - 1)
+        job.journal.close(remove=True)
+        job.status = 'COMPLETED'
     else:
-        while not QueueUrlDone.empty():
-            print 'Ignore fragment', QueueUrlDone.get()[1].fragNum
-        M6Item.status = 'COMPLETED'
+        for item in job.queueUrlDone.flush():
+            print 'Ignore fragment', item.fragNum
+            item.release()
+        if job.status == 'FINISHED':
+            finishOutput(job, currentFrag - 1)
+        elif job.output:
+            job.output.close()
+        # Keep the journal to resume from unless the stream ended early
+        job.journal.close(remove=job.status == 'FINISHED')
+        if job.status == 'FINISHED':
+            job.status = 'COMPLETED'
 
-def workerqd(errQueue):
-    error = None
+def workerqd(job):
     try:
-        workerqdRun()
+        workerqdRun(job)
     except Exception as e:
-        print sys.exc_info()
-        error = str(e)
-        traceback.print_exc(file=sys.stdout)
-        M6Item.status = 'STOPPED'
-        thread.interrupt_main()
-        while not QueueUrlDone.empty():
-            print 'Flush fragment', QueueUrlDone.get()[1].fragNum
-
-    if error:
-        errQueue.put(error)
+        failJob(job, str(e))
+        if job.output:
+            job.output.close()
+        for item in job.queueUrlDone.flush():
+            print 'Flush fragment', item.fragNum
+            item.release()
 
 validFilenameChars = "-_.() %s%s" % (string.ascii_letters, string.digits)
 
@@ -138,31 +2416,34 @@ def removeDisallowedFilenameChars(filename):
     return ''.join(c for c in cleanedFilename if c in validFilenameChars)              
 
 class M6(object):
-    def __init__(self, url, dest = '', proxy=None, maxbitrate=10000):
+    def __init__(self, url, dest = '', proxy=None, maxbitrate=10000, chunknum=1):
         self.status = 'INIT'
         self.url = url
+        self.chunkNum = chunknum
         self.dest = dest
         self.proxy = proxy
         self.maxbitrate = maxbitrate
         self.bitrate = 0
         self.duration = 0                        
         self.nbFragments = 0
+        self.fragments = []
+        self.segTable = {}
+        self.fragTable = {}
+        self.live = False
+        self.following = False
+        # Set by followLive once the bootstrap info says the stream is over
+        self.liveEnded = False
+        self.guessed = False
+        self.resumeFrag = 1
+        self.metrics = JobMetrics()
         self.tagHeaderLen = 11
         self.prevTagSize = 4
         self.urlbootstrap = ''
         self.bootstrapInfoId = ''
+        self.urlbootstrapInfo = None
         self.error = None
 
-        if hasUrllib3:
-            if self.proxy:
-                httpproxy = "http://%s/" % self.proxy
-                self.pm = urllib3.ProxyManager(httpproxy, num_pools=100)
-            else:
-                self.pm = urllib3.PoolManager(num_pools=100)
-        elif self.proxy:
-            proxy_handler = urllib2.ProxyHandler({'http':self.proxy})
-            opener = urllib2.build_opener(proxy_handler)
-            urllib2.install_opener(opener)
+        self.http = connectionPool(self.proxy)
 
         if self.url:
             self.manifest = self.getManifest(self.url)
@@ -174,42 +2455,143 @@ class M6(object):
             else:
                 self.error = "Unknown manifest version"
       
-    def download(self):
-        global QueueUrl, QueueUrlDone, M6Item, currChunknum
-        M6Item = self
+    def download(self, pool=None):
+        """
+        Download all the fragments to localfilename, fetching them through
+        pool (a FetchPool or AsyncFetcher shared with other jobs) or
+        through a pool of its own
+        """
         self.status = 'DOWNLOADING'
         # self.outFile = open(self.localfilename, "wb")
+        if FollowLive and self.live:
+            if self.urlbootstrapInfo:
+                # Start near the live edge, as AdobeHDS.php does
+                self.following = True
+                self.fragments = self.fragments[-max(LiveEdge, 1):]
+                self.nbFragments = len(self.fragments)
+            else:
+                print 'The bootstrap info is in the manifest, not following the live stream'
+        # Query strings often carry a per-session token, leave them out
+        urlp = urlparse(self.url)
+        outFilename = self.localfilename
+        if Positional:
+            outFilename += '.part'
+        self.journal = FragmentJournal(outFilename + '.journal', '%s %d' % (
+            urlunparse((urlp.scheme, urlp.netloc, urlp.path, '', '', '')), self.nbFragments))
+        if self.following:
+            # The live edge has moved on since
+            self.resumeFrag, self.resumeOffset = (1, 0)
+        else:
+            self.resumeFrag, self.resumeOffset = self.journal.resume(outFilename,
+                                                                     ordered=not Positional)
+        self.queueUrl = Queue.PriorityQueue()
+        self.queueUrlDone = ReorderBuffer(MaxBufferSize, self.resumeFrag)
+        self.errQueue = Queue.Queue()
+        self.metrics = JobMetrics()
+        self.fixer = None
+        self.flvFixer = None
+        if FlvFix:
+            self.flvFixer = FlvFixer.FlvFixer(FixWindow)
+            self.prepareMetadata()
+        elif FixTimestamps:
+            self.fixer = TimestampFixer()
+            self.prepareMetadata()
+        done = set()
+        self.output = None
+        if Positional:
+            self.output = FragmentFile(self, outFilename, self.journal, self.resumeOffset)
+            for fragNum, offset, length, crc in self.journal.entries:
+                # Already in the staging file
+                item = GetUrl(None, self.chunkNum, fragNum)
+                item.info = FragmentInfo(offset, offset + length)
+                self.queueUrlDone.put(item)
+                done.add(fragNum)
+            if done:
+                print 'Resuming with', len(done), 'fragments done'
+        self.journal.open()
+        # Fragments streamed to disk wait next to the output file
+        self.spoolDir = os.path.dirname(os.path.abspath(self.localfilename))
 
-        for i in range(self.nbFragments):
-            fragUrl = self.urlbootstrap + 'Seg1-Frag'+str(i + 1)
-            QueueUrl.put((i + 1, GetUrl(fragUrl, currChunknum, i + 1)))
+        for i, (segNum, fragNum) in enumerate(self.fragments):
+            if i + 1 < self.resumeFrag or i + 1 in done:
+                continue
+            self.queueFragment(i + 1, segNum, fragNum)
 
-        errQueue = Queue.Queue()
+        ownPool = pool is None
+        if ownPool:
+            pool = newFetchPool(self.proxy)
+        fetchPool = pool
+        if isinstance(pool, AsyncFetcher) and urlparse(self.urlbootstrap).scheme != 'http':
+            print 'The async engine only handles http://, using threads'
+            fetchPool = pool.threadPool()
 
-        t = threading.Thread(target=workerqd, args=(errQueue,))
+        t = threading.Thread(target=workerqd, args=(self,))
         t.start()
+        fetchPool.add(self)
 
-        for i in range(NumWorkerThreads):
-            t = threading.Thread(target=worker, args=(errQueue,))
-            t.start()
-
-        while self.status == 'DOWNLOADING':
+        nextRefresh = time.time() + LiveRefresh
+        nextProgress = time.time() + (ProgressInterval or 0)
+        while t.is_alive():
             try:
-                time.sleep(3)
+                t.join(min(1, ProgressInterval or 1))
+                if self.following and time.time() >= nextRefresh:
+                    self.followLive()
+                    nextRefresh = time.time() + LiveRefresh
+                if ProgressInterval and time.time() >= nextProgress:
+                    self.printProgress()
+                    nextProgress = time.time() + ProgressInterval
             except (KeyboardInterrupt, Exception), e:
                 print sys.exc_info()
                 traceback.print_exc(file=sys.stdout)
                 self.status = 'STOPPED'
 
+        fetchPool.remove(self)
+        if ownPool:
+            pool.close()
+
         if self.status != 'STOPPED':
             self.status = 'COMPLETED'
 
         try:
-            error = errQueue.get(False)
+            error = self.errQueue.get(False)
             return error
         except Exception:
             return None
 
+    def queueFragment(self, index, segNum, fragNum):
+        fragUrl = self.urlbootstrap + 'Seg%d-Frag%d' % (segNum, fragNum)
+        self.queueUrl.put((index, GetUrl(fragUrl, self.chunkNum, index)))
+
+    def followLive(self):
+        """
+        Fetch the bootstrap info of a live stream again (as
+        UpdateBootstrapInfo in AdobeHDS.php) and queue the fragments
+        published since the last time
+        """
+        try:
+            bootstrapInfo = self.getDocument(self.urlbootstrapInfo, 0)
+        except FetchError, e:
+            print 'Failed to refresh bootstrap info:', e
+            return
+        pos, boxType, boxSize = self.readBoxHeader(bootstrapInfo)
+        if boxType != 'abst':
+            print "Failed to parse bootstrap info"
+            return
+        self.parseBootstrapBox(bootstrapInfo, pos)
+        lastFrag = self.fragments[-1][1]
+        for segNum, fragNum in self.getFragmentList():
+            if fragNum > lastFrag:
+                self.fragments.append((segNum, fragNum))
+                self.queueFragment(len(self.fragments), segNum, fragNum)
+        self.nbFragments = len(self.fragments)
+        if not self.live:
+            self.liveEnded = True
+            self.following = False
+
+    def stopFollowing(self):
+        # Finish the fragments already queued and stop there
+        self.following = False
+
     def getInfos(self):
         infos = {}
         infos['status']        = self.status
@@ -219,36 +2601,50 @@ class M6(object):
         infos['bitrate']       = self.bitrate
         infos['duration']      = self.duration
         infos['nbFragments']   = self.nbFragments
+        infos['live']          = self.live
         infos['urlbootstrap']  = self.urlbootstrap
         infos['baseUrl']       = self.baseUrl
         infos['drmId']         = self.drmAdditionalHeaderId
+        infos['metrics']       = self.metrics.snapshot(self)
+        infos['connections']   = dict(self.http.stats)
+        infos['documentCache'] = dict(documentCache.stats)
+        if fragmentCache is not None:
+            infos['fragmentCache'] = dict(fragmentCache.stats)
+        if profiler is not None:
+            infos['profile'] = profiler.summary()
         return infos
 
-    if hasUrllib3:
-        def getFile(self, url):
-            headers = urllib3.make_headers(
-                keep_alive=True,
-                user_agent='Mozilla/5.0 (iPhone; U; CPU iPhone OS 4_3_2 like Mac OS X; en-us) AppleWebKit/533.17.9 (KHTML, like Gecko) Version/5.0.2 Mobile/8H7 Safari/653.18.5',
-                accept_encoding=True)
-            r = self.pm.request('GET', url, headers=headers)
-            if r.status != 200:
-                self.error = 'Error downloading: %s, %s' % (r.status, url)
-                print self.error
-            return r.data
-    else:
-        def getFile(self, url):
-            txheaders = {'User-Agent':
-                             'Mozilla/5.0 (iPhone; U; CPU iPhone OS 4_3_2 like Mac OS X; en-us) AppleWebKit/533.17.9 (KHTML, like Gecko) Version/5.0.2 Mobile/8H7 Safari/653.18.5',
-                         'Keep-Alive' : '600',
-                         'Connection' : 'keep-alive'
-                         }
-            request = urllib2.Request(url, None, txheaders)
-            response = urllib2.urlopen(request)
-            return response.read()
+    def printProgress(self):
+        infos = self.metrics.snapshot(self)
+        infos['file'] = os.path.basename(self.localfilename)
+        infos['status'] = self.status
+        infos['nbFragments'] = self.nbFragments
+        del infos['latencyBuckets']
+        print json.dumps({'progress': infos})
+
+    def getFile(self, url, fout=None, headers=None, info=None, cancel=None):
+        """
+        Return the body of url, or with fout write it there ChunkSize
+        bytes at a time and return its length
+        """
+        allHeaders = {'User-Agent': UserAgent,
+                      'Connection': 'keep-alive'}
+        if headers:
+            allHeaders.update(headers)
+        return self.http.get(url, allHeaders, fout, info, cancel)
+
+    def getDocument(self, url, ttl=None):
+        """
+        Return the manifest or bootstrap info at url, from documentCache
+        while it is fresh
+        """
+        if ttl is None:
+            ttl = CacheTTL
+        return documentCache.get(url, self.getFile, ttl)
 
     def getManifest(self, url):
         self.status = 'GETTING MANIFEST'
-        return xml.etree.ElementTree.fromstring(self.getFile(url))
+        return xml.etree.ElementTree.fromstring(self.getDocument(url))
 
     def manifestVersion(self):
         root = self.manifest
@@ -284,12 +2680,16 @@ class M6(object):
 
             # media
             self.media = None
+            suburl = None
             for media in root.findall('{http://ns.adobe.com/f4m/2.0}media'):
                 bitrate = int(media.attrib['bitrate'])
                 if bitrate > self.bitrate and bitrate <= self.maxbitrate:
                     self.bitrate = bitrate
                     suburl = media.attrib['href']
-                    submanifest = self.getManifest(suburl)
+            if suburl is None:
+                raise Exception("No media up to %d kbps" % self.maxbitrate)
+            # Only the selected media's manifest is fetched
+            submanifest = self.getManifest(suburl)
 
             self.url = suburl
             urlp = urlparse(self.url)
@@ -317,14 +2717,14 @@ class M6(object):
 
             # Duration
             self.duration = float(root.find("{http://ns.adobe.com/f4m/1.0}duration").text)
-            # nombre de fragment
-            self.nbFragments = int(math.ceil(self.duration/3))
             # streamid
             self.streamid = self.media.attrib['streamId']
             # Bootstrap URL
             self.urlbootstrap = self.media.attrib["url"]
             # urlbootstrap
             self.urlbootstrap = self.baseUrl + "/" + self.urlbootstrap
+            # nombre de fragment
+            self.parseBootstrapInfo(root)
         except Exception as e:
             self.error = "Not possible to parse the manifest: %s" % e
             print self.error
@@ -336,8 +2736,6 @@ class M6(object):
             root = self.manifest
             # Duration
             self.duration = float(root.find("{http://ns.adobe.com/f4m/1.0}duration").text)
-            # nombre de fragment
-            self.nbFragments = int(math.ceil(self.duration/3))
             # streamid
             self.streamid = root.findall("{http://ns.adobe.com/f4m/1.0}media")[-1]
             # media
@@ -369,19 +2767,216 @@ class M6(object):
 
             # urlbootstrap
             self.urlbootstrap = self.baseUrl + "/" + self.urlbootstrap
+            # nombre de fragment
+            self.parseBootstrapInfo(root)
         except Exception as e:
             self.error = "Not possible to parse the manifest: %s" % e
             print self.error
             traceback.print_exc()
 
+    def parseBootstrapInfo(self, root):
+        """
+        Build the list of (segment, fragment) to download from the
+        bootstrapInfo of the selected media.  Without one, fall back to
+        guessing 3 s fragments in segment 1.
+        """
+        bootstrap = None
+        for info in root.findall("{http://ns.adobe.com/f4m/1.0}bootstrapInfo"):
+            if bootstrap is None or info.attrib.get('id') == self.bootstrapInfoId:
+                bootstrap = info
+
+        self.fragments = []
+        if bootstrap is not None:
+            if 'url' in bootstrap.attrib:
+                self.urlbootstrapInfo = bootstrap.attrib['url']
+                if not self.urlbootstrapInfo.startswith('http'):
+                    self.urlbootstrapInfo = self.baseUrl + "/" + self.urlbootstrapInfo
+                bootstrapInfo = self.getDocument(self.urlbootstrapInfo)
+            else:
+                bootstrapInfo = base64.b64decode(bootstrap.text)
+            pos, boxType, boxSize = self.readBoxHeader(bootstrapInfo)
+            if boxType == 'abst':
+                self.parseBootstrapBox(bootstrapInfo, pos)
+                if self.live and self.urlbootstrapInfo:
+                    documentCache.expire(self.urlbootstrapInfo)
+                self.fragments = self.getFragmentList()
+            else:
+                print "Failed to parse bootstrap info"
+
+        if not self.fragments:
+            # A guess, the stream ends at the first fragment not found
+            nbFragments = int(math.ceil(self.duration/3))
+            self.fragments = [(1, i + 1) for i in range(nbFragments)]
+            self.guessed = True
+        self.nbFragments = len(self.fragments)
+
+    def parseBootstrapBox(self, bootstrapInfo, pos):
+        byte = self.readInt8(bootstrapInfo, pos + 8)
+        self.live = bool(byte & 0x20)
+        update = byte & 0x10
+        if not update:
+            self.segTable = {}
+            self.fragTable = {}
+        pos += 29
+        movieIdentifier, pos = self.readString(bootstrapInfo, pos)
+        serverEntryCount = self.readInt8(bootstrapInfo, pos)
+        pos += 1
+        for i in range(serverEntryCount):
+            serverEntry, pos = self.readString(bootstrapInfo, pos)
+        qualityEntryCount = self.readInt8(bootstrapInfo, pos)
+        pos += 1
+        for i in range(qualityEntryCount):
+            qualityEntry, pos = self.readString(bootstrapInfo, pos)
+        drmData, pos = self.readString(bootstrapInfo, pos)
+        metadata, pos = self.readString(bootstrapInfo, pos)
+
+        segTables = []
+        segRunTableCount = self.readInt8(bootstrapInfo, pos)
+        pos += 1
+        for i in range(segRunTableCount):
+            pos, boxType, boxSize = self.readBoxHeader(bootstrapInfo, pos)
+            if boxType == 'asrt':
+                segTables.append(self.parseAsrtBox(bootstrapInfo, pos))
+            pos += boxSize
+
+        fragTables = []
+        fragRunTableCount = self.readInt8(bootstrapInfo, pos)
+        pos += 1
+        for i in range(fragRunTableCount):
+            pos, boxType, boxSize = self.readBoxHeader(bootstrapInfo, pos)
+            if boxType == 'afrt':
+                fragTables.append(self.parseAfrtBox(bootstrapInfo, pos))
+            pos += boxSize
+
+        if segTables:
+            self.segTable.update(segTables[0])
+        if fragTables:
+            self.fragTable.update(fragTables[0])
+
+    def parseAsrtBox(self, asrt, pos):
+        segTable = {}
+        qualityEntryCount = self.readInt8(asrt, pos + 4)
+        pos += 5
+        for i in range(qualityEntryCount):
+            qualitySegmentUrlModifier, pos = self.readString(asrt, pos)
+        segCount = self.readInt32(asrt, pos)
+        pos += 4
+        for i in range(segCount):
+            firstSegment = self.readInt32(asrt, pos)
+            fragmentsPerSegment = self.readInt32(asrt, pos + 4)
+            if fragmentsPerSegment & 0x80000000:
+                fragmentsPerSegment = 0
+            segTable[firstSegment] = fragmentsPerSegment
+            pos += 8
+        return segTable
+
+    def parseAfrtBox(self, afrt, pos):
+        fragTable = {}
+        qualityEntryCount = self.readInt8(afrt, pos + 8)
+        pos += 9
+        for i in range(qualityEntryCount):
+            qualitySegmentUrlModifier, pos = self.readString(afrt, pos)
+        fragEntries = self.readInt32(afrt, pos)
+        pos += 4
+        for i in range(fragEntries):
+            firstFragment = self.readInt32(afrt, pos)
+            fragEntry = {
+                'firstFragment': firstFragment,
+                'firstFragmentTimestamp': self.readInt64(afrt, pos + 4),
+                'fragmentDuration': self.readInt32(afrt, pos + 12),
+                'discontinuityIndicator': None,
+            }
+            pos += 16
+            if fragEntry['fragmentDuration'] == 0:
+                fragEntry['discontinuityIndicator'] = self.readInt8(afrt, pos)
+                pos += 1
+            fragTable[firstFragment] = fragEntry
+        return fragTable
+
+    def getFragmentList(self):
+        """
+        Count the fragments announced by the segment and fragment run
+        tables (as ParseSegAndFragTable in AdobeHDS.php) and return the
+        (segment, fragment) pairs to download, leaving out discontinuities
+        """
+        if not self.segTable or not self.fragTable:
+            return []
+        segNums = sorted(self.segTable)
+        fragNums = sorted(self.fragTable)
+
+        # Check if live stream is still live
+        lastFragment = self.fragTable[fragNums[-1]]
+        if lastFragment['fragmentDuration'] == 0 and \
+           lastFragment['discontinuityIndicator'] == 0:
+            self.live = False
+            fragNums.pop()
+            if not fragNums:
+                return []
+
+        # Count total fragments by adding all entries in compactly coded segment table
+        fragCount = self.segTable[segNums[0]]
+        for prev, current in zip(segNums, segNums[1:]):
+            fragCount += (current - prev - 1) * self.segTable[prev]
+            fragCount += self.segTable[current]
+        fragCount += fragNums[0] - 1
+        if fragCount & 0x80000000:
+            fragCount = 0
+        if fragCount < fragNums[-1]:
+            fragCount = fragNums[-1]
+
+        fragments = []
+        segNum = segNums[0]
+        segEnd = fragNums[0] + self.segTable[segNum]
+        fragsPerSegment = self.segTable[segNum]
+        closest = 0
+        for fragNum in range(fragNums[0], fragCount + 1):
+            # Fragments covered by a discontinuity entry are not available
+            while closest + 1 < len(fragNums) and fragNums[closest + 1] <= fragNum:
+                closest += 1
+            if self.fragTable[fragNums[closest]]['discontinuityIndicator'] is not None:
+                continue
+            # Walk the segment run table along with the fragment numbers
+            while fragNum >= segEnd and segNum < segNums[-1]:
+                segNum += 1
+                fragsPerSegment = self.segTable.get(segNum, fragsPerSegment)
+                segEnd += fragsPerSegment
+            fragments.append((segNum, fragNum))
+        return fragments
+
     def stop(self):
         self.status = 'STOPPED'
     
-    def videoFragment(self, chunkNum, fragNum, data, fout):
-        start = M6Item.videostart(chunkNum, fragNum, data)
+    def videoFragment(self, chunkNum, fragNum, payload, fout, patches=None, tags=None):
+        """
+        Write a fragment and return the tagsCrc of what was written when
+        it is not the one of payload, None otherwise.  With tags (offset
+        and length of each tag in payload), they go through self.flvFixer.
+        """
         if fragNum == 1:
             self.videoBootstrap(fout)
-        fout.write(data[start:])
+        if tags is not None:
+            return self.writeFixed(fout, payload, tags)
+        if patches:
+            writePatched(fout, payload, patches)
+        else:
+            fout.write(payload)
+        return None
+
+    def writeFixed(self, fout, payload, tags):
+        written = []
+        for offset, length in tags:
+            tag = self.flvFixer.fix(payload[offset:offset + length])
+            if tag is not None:
+                fout.write(tag)
+                written.append(tag)
+        if sum(len(tag) for tag in written) == len(payload):
+            # Only timestamps changed
+            return None
+        return tagsCrc(''.join(written))
+
+    def bootstrapSize(self):
+        # FLV header, script tag and its previous tag size
+        return 13 + self.tagHeaderLen + len(self.flvHeader) + 4
 
     def videoBootstrap(self, fout):
         # Ajout de l'en-tête FLV
@@ -393,102 +2988,272 @@ class M6(object):
         fout.write(binascii.a2b_hex(bootstrap))
         # Ajout de l'header du fichier
         fout.write(self.flvHeader)
-        fout.write(binascii.a2b_hex("00019209"))
+        fout.write(UInt32.pack(self.tagHeaderLen + len(self.flvHeader)))
 
-    def videostart(self, chunkNum, fragNum, fragData):
+    def prepareMetadata(self):
         """
-        Trouve le debut de la video dans un fragment
+        Make room for the duration in the onMetaData of the FLV header if
+        it has none, and remember where it is to set it at the end
         """
-        start = fragData.find("mdat") + 12
-        # print "start ", start
-        # For all fragment (except frag1)
-        if fragNum == 1:
-            start += 0
-        else:
-            # Skip 2 FLV tags
-            for dummy in range(2):
-                tagLen, = struct.unpack_from(">L", fragData, start)  # Read 32 bits (big endian)
-                # print 'tagLen = %X' % tagLen
-                tagLen &= 0x00ffffff  # Take the last 24 bits
-                # print 'tagLen2 = %X' % tagLen
-                start += tagLen + self.tagHeaderLen + 4  # 11 = tag header len ; 4 = tag footer len
-        return start           
+        self.durationOffset = None
+        meta = self.flvHeader
+        key = '\x00\x08duration\x00'
+        pos = meta.find(key)
+        if pos < 0:
+            if meta[:13] != '\x02\x00\x0aonMetaData':
+                return
+            if meta[13:14] == '\x08':
+                count = self.readInt32(meta, 14) + 1
+                meta = meta[:14] + UInt32.pack(count) + key + Double.pack(0) + meta[18:]
+                pos = 18
+            elif meta[13:14] == '\x03':
+                meta = meta[:14] + key + Double.pack(0) + meta[14:]
+                pos = 14
+            else:
+                return
+            self.flvHeader = meta
+        # After the FLV header, the first previous tag size and the tag header
+        self.durationOffset = 24 + pos + len(key)
+
+    def writeDuration(self, filename, duration):
+        if self.durationOffset is None or duration is None:
+            return
+        with open(filename, "r+b") as f:
+            f.seek(self.durationOffset)
+            f.write(Double.pack(duration))
 
     def readBoxHeader(self, data, pos=0):
-        boxSize, = struct.unpack_from(">L", data, pos)  # Read 32 bits (big endian)struct.unpack_from(">L", data, pos)  # Read 32 bits (big endian)
-        boxType = data[pos + 4 : pos + 8]
-        if boxSize == 1:
-            boxSize, = struct.unpack_from(">Q", data, pos + 8)  # Read 64 bits (big endian)
-            boxSize -= 16
-            pos += 16
-        else:
-            boxSize -= 8
-            pos += 8
-        if boxSize <= 0:
-            boxSize = 0
-        return (pos, boxType, boxSize)
-
-    def verifyFragment(self, data):
-        pos = 0
-        fragLen = len(data)
-        print fragLen
-        while pos < fragLen:
-            pos, boxType, boxSize = self.readBoxHeader(data, pos)
-            if boxType == 'mdat':
-                slen = len(data[pos:])
-                print 'mdat %s' % (slen,)
-                if boxSize and slen == boxSize:
-                    return True
-                else:
-                    boxSize = fraglen - pos
-            pos += boxSize
-        return False
+        return readBoxHeader(data, pos)
 
-    def decodeFragment(self, fragNum, data):
-        fragPos = 0
-        fragLen = len(data)
-        if not self.verifyFragment(data):
+    def parseFragment(self, fragNum, data):
+        info = parseFragment(fragNum, data)
+        if info is None:
             print "Skipping fragment number", fragNum
-            return False
-        while fragPos < fragLen:
-            fragPos, boxType, boxSize = self.readBoxHeader(data, fragPos)
-            if boxType == 'mdat':
-                fragLen = fragPos + boxSize
-                break
-            fragPos += boxSize
-        while fragPos < fragLen:
-            packetType = self.readInt8(data, fragPos)
-            packetSize = self.readInt24(data, fragPos + 1)
-            packetTS = self.readInt24(data, fragPos + 4)
-            packetTS |= self.readInt8(data, fragPos + 7) << 24
-            if packetTS & 0x80000000:
-                packetTS &= 0x7FFFFFFF
-            totalTagLen = self.tagHeaderLen + packetSize + self.prevTagSize
-            # print 'decodeFragment', fragNum, packetType, packetSize, packetTS, totalTagLen
-            # time.sleep(1)
-            if packetType in (10, 11):
-                print "This stream is encrypted with Akamai DRM. Decryption of such streams isn't currently possible with this script."
-                raise Exception('Akamai DRM')
-            if packetType in (40, 41):
-                print "This stream is encrypted with FlashAccess DRM. Decryption of such streams isn't currently possible with this script."
-                raise Exception('FlashAccess DRM')
-            fragPos += totalTagLen
-        return True
+        return info
 
     def readInt8(self, data, pos):
-        return ord(struct.unpack_from(">c", data, pos)[0])
+        return UInt8.unpack_from(data, pos)[0]
 
     def readInt24(self, data, pos):
-        return struct.unpack_from(">L", "\0" + data[pos:pos + 3], 0)[0]
+        return (UInt8.unpack_from(data, pos)[0] << 16) | UInt16.unpack_from(data, pos + 1)[0]
+
+    def readInt32(self, data, pos):
+        return UInt32.unpack_from(data, pos)[0]
+
+    def readInt64(self, data, pos):
+        return UInt64.unpack_from(data, pos)[0]
+
+    def readString(self, data, pos):
+        end = data.index("\0", pos)
+        return (data[pos:end], end + 1)
+
+class JobScheduler(object):
+    """
+    Downloads several manifests at once, up to maxJobs at a time, over one
+    shared fetch pool.  Jobs keep the order of their urls: once one fails,
+    the jobs after it are stopped and not reported.
+    """
+    def __init__(self, urls, maxJobs, pool, **options):
+        self.urls = urls
+        self.maxJobs = maxJobs
+        self.pool = pool
+        self.options = options
+        self.jobs = [None] * len(urls)
+        self.errors = [None] * len(urls)
+        self.firstFailed = len(urls)
+        # Output file names, given out in url order
+        self.names = set()
+        self.named = [False] * len(urls)
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+
+    def fail(self, index, error):
+        with self.lock:
+            self.errors[index] = error
+            if index < self.firstFailed:
+                self.firstFailed = index
+            for job in self.jobs[self.firstFailed + 1:]:
+                if job:
+                    job.stop()
+
+    def runJob(self, index):
+        try:
+            self.downloadJob(index)
+        except Exception as e:
+            traceback.print_exc(file=sys.stdout)
+            self.fail(index, str(e))
+        finally:
+            self.setName(index, None)
+
+    def setName(self, index, job):
+        """
+        Give job its output file name once the jobs before it have theirs,
+        adding the chunk number when it is taken (stack items are all
+        manifest.flv)
+        """
+        with self.cond:
+            if self.named[index]:
+                return
+            while not all(self.named[:index]):
+                self.cond.wait()
+            if job:
+                if job.localfilename in self.names:
+                    name, ext = os.path.splitext(job.localfilename)
+                    job.localfilename = '%s_%d%s' % (name, job.chunkNum, ext)
+                self.names.add(job.localfilename)
+            self.named[index] = True
+            self.cond.notify_all()
+
+    def downloadJob(self, index):
+        st = time.time()
+        x = M6(self.urls[index], chunknum=index + 1, **self.options)
+        self.jobs[index] = x
+        if x.error:
+            self.fail(index, x.error)
+            return
+        self.setName(index, x)
+        if index > self.firstFailed:
+            return
+        infos = x.getInfos()
+        for item in infos.items():
+            print item[0]+' : '+str(item[1])
+        error = x.download(self.pool)
+        print 'Download time:', time.time() - st
+        if x.status == 'STOPPED' and not error:
+            error = "Download stopped"
+        if error:
+            self.fail(index, error)
+
+    def run(self):
+        """
+        Run all the jobs, and return the local file names of the ones that
+        completed before the first failure, in order, with its error
+        """
+        threads = {}
+        nextJob = 0
+        while nextJob < len(self.urls) or threads:
+            try:
+                while nextJob < self.firstFailed and len(threads) < self.maxJobs:
+                    t = threading.Thread(target=self.runJob, args=(nextJob,))
+                    t.daemon = True
+                    t.start()
+                    threads[nextJob] = t
+                    nextJob += 1
+                if nextJob >= self.firstFailed:
+                    nextJob = len(self.urls)
+                for index, t in threads.items():
+                    t.join(0.1)
+                    if not t.is_alive():
+                        del threads[index]
+            except KeyboardInterrupt:
+                following = [job for job in self.jobs if job and job.following]
+                if following:
+                    # The first ^C ends the live streams cleanly
+                    print 'Stopping the live streams after the queued fragments'
+                    for job in following:
+                        job.stopFollowing()
+                    continue
+                print sys.exc_info()
+                # The jobs before the first one not completed are kept
+                index = 0
+                while index < len(self.jobs) and self.jobs[index] and \
+                      self.jobs[index].status == 'COMPLETED':
+                    index += 1
+                if index < len(self.jobs):
+                    self.fail(index, "Download stopped")
+                for job in self.jobs[index:]:
+                    if job:
+                        job.stop()
+
+        sections = []
+        for index, job in enumerate(self.jobs):
+            if job is None or job.error:
+                break
+            sections.append(os.path.split(job.localfilename)[1])
+            if self.errors[index]:
+                break
+        error = None
+        if self.firstFailed < len(self.urls):
+            error = self.errors[self.firstFailed]
+        return (sections, error)
 
 def main():
-    global NumWorkerThreads, currChunknum
+    global NumWorkerThreads, Adaptive, Engine, MaxConnections, MaxBufferSize, MaxRetries
+    global Streaming, Positional, FollowLive, LiveRefresh, LiveEdge, FixTimestamps, FlvFix
+    global ProgressInterval, MaxHostConnections, HostOverflow, CacheTTL, fragmentCache, documentCache
+    global Hedging, HedgePercentile, profiler
     parser = argparse.ArgumentParser(description="Grab AdobeHDS format files")
     parser.add_argument("--proxy", dest='proxy', action='store',
                         help='HTTP Proxy to use')
     parser.add_argument("--threads", dest='threads', action='store', type=int,
                         help='number of threads to use', default=7,
-                        choices=range(1, 16))
+                        choices=range(1, MaxWorkerThreads + 1))
+    parser.add_argument("--adaptive", dest='adaptive', action='store_true',
+                        help='adapt the number of fragments fetched at once to '
+                             'the measured throughput, starting from --threads')
+    parser.add_argument("--engine", dest='engine', action='store',
+                        help='fetch fragments with worker threads or an event loop',
+                        default='threads', choices=['threads', 'async'])
+    parser.add_argument("--connections", dest='connections', action='store',
+                        type=int, default=64,
+                        help='requests in flight with --engine async')
+    parser.add_argument("--hostconnections", dest='hostconnections', action='store',
+                        type=int, help='keep-alive connections to each host '
+                        '(default: one per thread, and one more)')
+    parser.add_argument("--hostoverflow", dest='hostoverflow', action='store_true',
+                        help='open an extra connection when all the ones to a host '
+                        'are busy, instead of waiting for one')
+    parser.add_argument("--cachettl", dest='cachettl', action='store', type=int,
+                        help='seconds manifests and bootstrap infos are reused '
+                        'before revalidating them', default=60)
+    parser.add_argument("--doccache", dest='doccache', action='store',
+                        help='directory to keep manifests and bootstrap infos in, '
+                        'to reuse them in later runs')
+    parser.add_argument("--fragcache", dest='fragcache', action='store',
+                        help='directory to keep downloaded fragments in, to '
+                        'reuse them in later jobs and runs')
+    parser.add_argument("--fragcachesize", dest='fragcachesize', action='store',
+                        type=int, help='size of the fragment cache in MB',
+                        default=1024)
+    parser.add_argument("--hedge", dest='hedge', action='store_true',
+                        help='send a second request for fragments that are late, '
+                        'using whichever answer comes first')
+    parser.add_argument("--hedgepercentile", dest='hedgepercentile', action='store',
+                        type=int, help='percentile of the recent download times '
+                        'after which a fragment is late', default=90)
+    parser.add_argument("--retries", dest='retries', action='store',
+                        type=int, default=MaxRetries,
+                        help='times to retry a fragment before giving up')
+    parser.add_argument("--maxbuffer", dest='maxbuffer', action='store',
+                        type=int, default=64,
+                        help='memory (MB) to hold fragments downloaded ahead of the writer '
+                             '(disk space with --stream)')
+    parser.add_argument("--stream", dest='stream', action='store_true',
+                        help='stream fragments to temporary files next to the output '
+                             'instead of holding them in memory')
+    parser.add_argument("--positional", dest='positional', action='store_true',
+                        help='write fragments to a staging file as they arrive '
+                             'and put them in order at the end')
+    parser.add_argument("--live", dest='live', action='store_true',
+                        help='keep following live streams until they end or ^C')
+    parser.add_argument("--refresh", dest='refresh', action='store',
+                        type=float, default=LiveRefresh,
+                        help='seconds between bootstrap info updates with --live')
+    parser.add_argument("--liveedge", dest='liveedge', action='store',
+                        type=int, default=LiveEdge,
+                        help='start --live this many fragments before the newest one '
+                             '(a large value starts at the beginning of a DVR window)')
+    parser.add_argument("--keepts", dest='keepts', action='store_true',
+                        help='write the tag timestamps as they are in the fragments')
+    parser.add_argument("--flvfix", dest='flvfix', action='store_true',
+                        help='repair the tags as FlvFixer does while writing them')
+    parser.add_argument("--progress", dest='progress', action='store',
+                        type=float, help='print a JSON progress line every PROGRESS seconds')
+    parser.add_argument("--profile", dest='profile', action='store',
+                        help='time every stage of every fragment, print a summary '
+                        'and write a Chrome trace-event JSON file to PROFILE')
+    parser.add_argument("--metricsport", dest='metricsport', action='store',
+                        type=int, help='serve metrics on http://127.0.0.1:METRICSPORT/metrics')
     parser.add_argument("urls", metavar='U', nargs='*',
                         help='manifest URLs to grab from')
     parser.add_argument("--outdir", dest='outdir', action='store',
@@ -500,15 +3265,43 @@ def main():
                         default=10000)
     parser.add_argument("--jsonout", dest='jsonout', action='store',
                         help='JSON output file')
+    parser.add_argument("--jobs", dest='jobs', action='store', type=int,
+                        help='number of manifests to download at once',
+                        default=1)
     args = parser.parse_args()
 
     NumWorkerThreads = args.threads
+    Adaptive = args.adaptive
+    Engine = args.engine
+    MaxConnections = args.connections
+    MaxBufferSize = args.maxbuffer * 1024 * 1024
+    MaxRetries = args.retries
+    Streaming = args.stream
+    Positional = args.positional
+    FollowLive = args.live
+    LiveRefresh = args.refresh
+    LiveEdge = args.liveedge
+    FixTimestamps = not args.keepts
+    FlvFix = args.flvfix
+    if FlvFix and FlvFixer is None:
+        print "--flvfix needs FlvFixer.py next to AdobeHDS.py"
+        sys.exit(1)
+    ProgressInterval = args.progress
+    MaxHostConnections = args.hostconnections
+    HostOverflow = args.hostoverflow
+    CacheTTL = args.cachettl
+    Hedging = args.hedge
+    HedgePercentile = args.hedgepercentile
+    if args.doccache:
+        documentCache = DocumentCache(MaxCacheEntries, args.doccache)
+    if args.fragcache:
+        fragmentCache = FragmentCache(args.fragcache, args.fragcachesize * 1024 * 1024)
+    if args.profile:
+        profiler = Profiler()
     urls = args.urls
     if not urls:
         urls = []
 
-    sections = []
-
     if args.stack:
         x = M6(None, dest=args.outdir, proxy=args.proxy)
         print args.stack
@@ -519,26 +3312,20 @@ def main():
         for item in items:
             urls.append(args.stack + "/%s/manifest.f4m" % item['Id'])
 
-    currChunknum = 1
-    error = None
-    for url in urls:
-        st = time.time()
-        x = M6(url, dest=args.outdir, proxy=args.proxy,
-               maxbitrate=args.maxbitrate)
-        if x.error:
-            error = x.error
-            break
-        sections.append(os.path.split(x.localfilename)[1])
-        infos = x.getInfos()
-        for item in infos.items():
-            print item[0]+' : '+str(item[1])
-        error = x.download()
-        print 'Download time:', time.time() - st
-        currChunknum += 1
-        if x.status == 'STOPPED' and not error:
-            error = "Download stopped"
-        if error:
-            break
+    pool = newFetchPool(args.proxy)
+    scheduler = JobScheduler(urls, args.jobs, pool, dest=args.outdir,
+                             proxy=args.proxy, maxbitrate=args.maxbitrate)
+    if args.metricsport:
+        metricsServer = MetricsServer(args.metricsport, scheduler)
+    sections, error = scheduler.run()
+    pool.close()
+    for http in connectionPools.values():
+        http.close()
+    if args.metricsport:
+        metricsServer.shutdown()
+    if args.profile:
+        profiler.printSummary()
+        profiler.dumpTrace(args.profile)
 
     if args.jsonout:
         files = { 'segments' : sections }
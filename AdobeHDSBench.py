@@ -0,0 +1,340 @@
+#! /usr/bin/python
+# vim:ts=4:sw=4:ai:et:si:sts=4:fileencoding=utf-8
+
+# Benchmarks for AdobeHDS.py with synthetic F4F fragments served locally
+import struct
+import sys
+import os
+import base64
+import time
+import json
+import shutil
+import tempfile
+import subprocess
+import threading
+import argparse
+import BaseHTTPServer
+import SocketServer
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import AdobeHDS
+
+def box(boxType, body, large=False):
+    if large:
+        return struct.pack(">L4sQ", 1, boxType, len(body) + 16) + body
+    return struct.pack(">L4s", len(body) + 8, boxType) + body
+
+def tag(tagType, ts, data):
+    header = struct.pack(">L", (tagType << 24) | len(data)) + \
+             struct.pack(">L", ((ts & 0x00FFFFFF) << 8) | ((ts >> 24) & 0xFF)) + "\0\0\0"
+    return header[:11] + data + struct.pack(">L", len(data) + 11)
+
+def fragment(fragNum, tags=50, tagSize=2000, fragDuration=4000, large=True, boxes=2, base=0):
+    """
+    A fragment with boxes boxes before an mdat holding the AVC and AAC
+    sequence headers and tags alternating video and audio tags, the
+    stream starting at base ms
+    """
+    ts = base + (fragNum - 1) * fragDuration
+    flv = [tag(9, ts, "\x17\x00\x00\x00\x00" + "H" * 20),
+           tag(8, ts, "\xaf\x00" + "A" * 4)]
+    for i in range(tags):
+        if i % 2:
+            flv.append(tag(8, ts + i * fragDuration // tags, "\xaf\x01" + "a" * (tagSize // 4)))
+        else:
+            flv.append(tag(9, ts + i * fragDuration // tags, "\x27\x01\x00\x00\x00" + "v" * tagSize))
+    data = box("afra", "\0" * 9)
+    for i in range(boxes - 1):
+        data += box("free", "\0" * 30)
+    return data + box("mdat", "".join(flv), large)
+
+def bootstrap(fragments, fragDuration=4000):
+    asrt = "\0\0\0\0\0" + struct.pack(">LLL", 1, 1, fragments)
+    afrt = "\0\0\0\0" + struct.pack(">L", 1000) + "\0" + \
+           struct.pack(">LLQL", 1, 1, 0, fragDuration)
+    abst = "\0\0\0\0" + struct.pack(">LBL", 1, 0, 1000) + \
+           struct.pack(">QQ", fragments * fragDuration, 0) + "\0\0\0\0\0" + \
+           "\1" + box("asrt", asrt) + "\1" + box("afrt", afrt)
+    return box("abst", abst)
+
+def manifest(fragments, fragDuration=4000):
+    metadata = "\x02\x00\x0aonMetaData\x08\x00\x00\x00\x00\x00\x00\x09"
+    return ('<?xml version="1.0"?>\n'
+            '<manifest xmlns="http://ns.adobe.com/f4m/1.0">\n'
+            '<id>bench</id><duration>%f</duration>\n'
+            '<bootstrapInfo profile="named" id="bootstrap1">%s</bootstrapInfo>\n'
+            '<media streamId="bench" url="bench-" bitrate="1000" bootstrapInfoId="bootstrap1">'
+            '<metadata>%s</metadata></media>\n'
+            '</manifest>\n' % (fragments * fragDuration / 1000.0,
+                               base64.b64encode(bootstrap(fragments, fragDuration)),
+                               base64.b64encode(metadata)))
+
+class FragmentHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves manifest.f4m and its fragments over keep-alive connections,
+    answering each fragment after server.delay seconds
+    """
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in two writes, which Nagle would hold
+    # for the client's delayed ACK on a keep-alive connection
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path.endswith('.f4m'):
+            body = self.server.manifest
+        elif 'Frag' in path:
+            fragNum = int(path.rsplit('Frag', 1)[1])
+            body = self.server.fragments.get(fragNum)
+            if fragNum == self.server.failing:
+                self.send_response(503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if self.server.delay:
+                time.sleep(self.server.delay)
+        else:
+            body = None
+        if body is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class FragmentServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 delays the connections after it by 1 s
+    request_queue_size = 128
+
+    def __init__(self, fragments, delay, **layout):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), FragmentHandler)
+        self.delay = delay
+        # Fragment answered with a 503
+        self.failing = None
+        self.manifest = manifest(fragments)
+        self.fragments = {}
+        for fragNum in range(1, fragments + 1):
+            self.fragments[fragNum] = fragment(fragNum, **layout)
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self):
+        return 'http://127.0.0.1:%d/bench/manifest.f4m' % self.server_address[1]
+
+def peakRss():
+    # In MB, ru_maxrss is in KB on Linux
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def benchParse(layouts, fragments, repeat):
+    """
+    Time parsing and preparing fragments of each layout, as the download
+    workers do, and return the MB/s for each
+    """
+    job = AdobeHDS.M6(None)
+    results = []
+    for name, layout in layouts:
+        data = [fragment(fragNum, **layout) for fragNum in range(1, fragments + 1)]
+        size = sum(len(d) for d in data) * repeat
+        st = time.time()
+        for i in range(repeat):
+            for fragNum, d in enumerate(data):
+                item = AdobeHDS.GetUrl(None, 1, fragNum + 1)
+                item.data = d
+                AdobeHDS.prepareFragment(job, item)
+        elapsed = time.time() - st
+        results.append((name, size / elapsed / 1024 / 1024))
+    return results
+
+def runDownload(args):
+    """
+    Child side of benchDownload: download args.child and return the
+    measures
+    """
+    AdobeHDS.NumWorkerThreads = args.threads
+    AdobeHDS.Engine = args.engine
+    AdobeHDS.Streaming = args.stream
+    AdobeHDS.Positional = args.positional
+    dest = tempfile.mkdtemp()
+    try:
+        st = time.time()
+        job = AdobeHDS.M6(args.child, dest=dest)
+        job.download()
+        elapsed = time.time() - st
+        size = os.path.getsize(job.localfilename)
+        return {
+            'status': job.status,
+            'seconds': elapsed,
+            'mbps': size / elapsed / 1024 / 1024,
+            'writerStall': job.queueUrlDone.waitTime,
+            'peakRss': peakRss(),
+        }
+    finally:
+        shutil.rmtree(dest)
+
+def checkResume(fragments, stopAt, layout):
+    """
+    Download a stream whole, then again stopping at fragment stopAt and
+    resuming, with each timestamp fixer and a stream starting at 0 and
+    late.  Return (name, True if both outputs are the same bytes) for
+    each.
+    """
+    AdobeHDS.NumWorkerThreads = 4
+    results = []
+    for base in (0, 10000000):
+        server = FragmentServer(fragments, 0, base=base, **layout)
+        for name, fixTimestamps, flvFix in (('timestamps', True, False),
+                                            ('flvfix', False, True)):
+            AdobeHDS.FixTimestamps = fixTimestamps
+            AdobeHDS.FlvFix = flvFix
+            whole = tempfile.mkdtemp()
+            resumed = tempfile.mkdtemp()
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, "w")
+            try:
+                job = AdobeHDS.M6(server.url(), dest=whole)
+                job.download()
+                server.failing = stopAt
+                AdobeHDS.MaxRetries = 0
+                first = AdobeHDS.M6(server.url(), dest=resumed)
+                first.download()
+                server.failing = None
+                AdobeHDS.MaxRetries = 6
+                second = AdobeHDS.M6(server.url(), dest=resumed)
+                second.download()
+                with open(job.localfilename, "rb") as f:
+                    expected = f.read()
+                with open(second.localfilename, "rb") as f:
+                    same = f.read() == expected
+                # The writer may stop a fragment or more before stopAt
+                ok = first.status == 'STOPPED' and 1 < second.resumeFrag <= stopAt and \
+                     second.status == 'COMPLETED' and same
+            finally:
+                sys.stdout = stdout
+                shutil.rmtree(whole)
+                shutil.rmtree(resumed)
+            results.append(('%s, starting at %d ms' % (name, base), ok))
+        server.shutdown()
+    for http in AdobeHDS.connectionPools.values():
+        http.close()
+    return results
+
+def benchDownload(url, threads, options):
+    """
+    Download url once for each number of threads, each time in a new
+    process so that its peak RSS is its own
+    """
+    results = []
+    for n in threads:
+        cmd = [sys.executable, os.path.abspath(__file__), '--child', url,
+               '--threads', str(n)] + options
+        out = subprocess.check_output(cmd)
+        results.append((n, json.loads(out.strip().splitlines()[-1])))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for AdobeHDS.py')
+    parser.add_argument("--fragments", dest='fragments', type=int, default=50,
+                        help='fragments in the stream')
+    parser.add_argument("--tags", dest='tags', type=int, default=50,
+                        help='FLV tags per fragment')
+    parser.add_argument("--tagsize", dest='tagsize', type=int, default=2000,
+                        help='bytes of video tag data (audio tags are a quarter)')
+    parser.add_argument("--boxes", dest='boxes', type=int, default=2,
+                        help='boxes before the mdat box')
+    parser.add_argument("--small", dest='small', action='store_true',
+                        help='32 bits mdat box size instead of 64 bits')
+    parser.add_argument("--repeat", dest='repeat', type=int, default=5,
+                        help='passes over the fragments for the parse benchmark')
+    parser.add_argument("--threads", dest='threads', default='1,4,7,15',
+                        help='thread counts to download with')
+    parser.add_argument("--delay", dest='delay', type=float, default=0.02,
+                        help='seconds the server waits before each fragment')
+    parser.add_argument("--engine", dest='engine', default='threads',
+                        choices=['threads', 'async'])
+    parser.add_argument("--stream", dest='stream', action='store_true',
+                        help='download with --stream')
+    parser.add_argument("--positional", dest='positional', action='store_true',
+                        help='download with --positional')
+    parser.add_argument("--json", dest='json', action='store',
+                        help='also write the results to this JSON file')
+    parser.add_argument("--checkresume", dest='checkresume', action='store', type=int,
+                        help='only check that a download stopped at this fragment and '
+                        'resumed is the same as one not stopped')
+    parser.add_argument("--child", dest='child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        args.threads = int(args.threads)
+        # Only the JSON line goes to the parent
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            result = runDownload(args)
+        finally:
+            sys.stdout = stdout
+        print json.dumps(result)
+        return
+
+    layout = {'tags': args.tags, 'tagSize': args.tagsize,
+              'large': not args.small, 'boxes': args.boxes}
+    if args.checkresume:
+        print 'Resume at fragment %d (%d fragments)' % (args.checkresume, args.fragments)
+        results = checkResume(args.fragments, args.checkresume, layout)
+        for name, ok in results:
+            print '  %-36s %s' % (name, 'same' if ok else 'DIFFERENT')
+        sys.exit(0 if all(ok for name, ok in results) else 1)
+    layouts = [('requested', layout),
+               ('32-bit mdat', dict(layout, large=False)),
+               ('64-bit mdat', dict(layout, large=True)),
+               ('many small tags', dict(layout, tags=layout['tags'] * 10,
+                                        tagSize=max(layout['tagSize'] // 10, 8))),
+               ('8 boxes', dict(layout, boxes=8))]
+
+    print 'Parse (%d fragments x %d)' % (args.fragments, args.repeat)
+    parse = benchParse(layouts, args.fragments, args.repeat)
+    for name, mbps in parse:
+        print '  %-16s %8.1f MB/s' % (name, mbps)
+
+    server = FragmentServer(args.fragments, args.delay, tags=args.tags,
+                            tagSize=args.tagsize, large=not args.small,
+                            boxes=args.boxes)
+    options = ['--engine', args.engine]
+    if args.stream:
+        options.append('--stream')
+    if args.positional:
+        options.append('--positional')
+    threads = [int(n) for n in args.threads.split(',')]
+    print 'Download (%d fragments, %.0f ms per request, %s)' % (
+        args.fragments, args.delay * 1000, ' '.join(options))
+    print '  %7s %8s %10s %12s %10s' % ('threads', 'seconds', 'MB/s', 'writer stall', 'peak RSS')
+    download = benchDownload(server.url(), threads, options)
+    for n, result in download:
+        rss = result['peakRss']
+        print '  %7d %8.2f %10.1f %11.2fs %10s' % (
+            n, result['seconds'], result['mbps'], result['writerStall'],
+            '%.1f MB' % rss if rss is not None else '-')
+    server.shutdown()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(json.dumps({
+                'parse': dict(parse),
+                'download': dict((str(n), result) for n, result in download),
+            }))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,490 @@
+#! /usr/bin/python
+# vim:ts=4:sw=4:ai:et:si:sts=4:fileencoding=utf-8
+
+# Python port of FlvFixer.php and BeatConvert.php.  FlvFixer repairs a
+# stream of FLV tags one tag at a time, so AdobeHDS.py can run it while
+# writing (--flvfix); from the command line it repairs existing files,
+# and whole directories of them with a pool of processes.
+import struct
+import sys
+import os
+import time
+import glob
+import argparse
+import multiprocessing
+try:
+    from Crypto.Cipher import AES
+except ImportError:
+    AES = None
+
+AUDIO = 0x08
+VIDEO = 0x09
+SCRIPT_DATA = 0x12
+FRAME_TYPE_INFO = 0x05
+CODEC_ID_AVC = 0x07
+CODEC_ID_AAC = 0x0A
+AVC_SEQUENCE_HEADER = 0x00
+AAC_SEQUENCE_HEADER = 0x00
+AVC_NALU = 0x01
+AVC_SEQUENCE_END = 0x02
+FRAMEFIX_STEP = 40
+INVALID_TIMESTAMP = -1
+
+UInt16 = struct.Struct(">H")
+UInt32 = struct.Struct(">L")
+
+FlvHeader = "FLV\x01\x05\x00\x00\x00\x09\x00\x00\x00\x00"
+TagHeaderLen = 11
+PrevTagSize = 4
+
+def readInt24(data, pos):
+    return UInt32.unpack("\0" + data[pos:pos + 3])[0]
+
+def setTimestamp(tag, packetTS):
+    return tag[:4] + UInt32.pack(packetTS & 0x00FFFFFF)[1:] + \
+           chr((packetTS >> 24) & 0xFF) + tag[8:]
+
+def flvHeader(audio=True, video=True):
+    # Set proper Audio/Video marker
+    return FlvHeader[:4] + chr(audio << 2 | video) + FlvHeader[5:]
+
+class FlvFixer(object):
+    """
+    Repairs FLV tags as FlvFixer.php does: timestamps are made zero based
+    and monotonic per stream, gaps longer than fixWindow are closed,
+    repeated AVC/AAC sequence headers, media before them and video info
+    frames are dropped, and script data is kept only with metadata
+    """
+    def __init__(self, fixWindow=1000, metadata=True, debug=False):
+        self.fixWindow = fixWindow
+        self.metadata = metadata
+        self.debug = debug
+        self.audio = False
+        self.video = False
+        self.baseTS = INVALID_TIMESTAMP
+        self.negTS = INVALID_TIMESTAMP
+        self.prevAudioTS = INVALID_TIMESTAMP
+        self.prevVideoTS = INVALID_TIMESTAMP
+        self.prevAVCHeader = False
+        self.prevAACHeader = False
+        self.avcHeaderWritten = False
+        self.aacHeaderWritten = False
+
+    def log(self, msg):
+        if self.debug:
+            sys.stderr.write(msg + "\n")
+
+    def resume(self, prevTS, state=()):
+        """
+        Carry on after the tags already written, prevTS holding the
+        timestamp of the last audio (8) and video (9) tags and state what
+        state() returned after them
+        """
+        self.prevAudioTS = prevTS.get(AUDIO, INVALID_TIMESTAMP)
+        self.prevVideoTS = prevTS.get(VIDEO, INVALID_TIMESTAMP)
+        self.audio = self.aacHeaderWritten = AUDIO in prevTS
+        self.video = self.avcHeaderWritten = VIDEO in prevTS
+        if state:
+            self.baseTS, self.negTS = state
+
+    def state(self):
+        # What resume() needs besides the timestamps written
+        return (self.baseTS, self.negTS)
+
+    @property
+    def lastTS(self):
+        lastTS = max(self.prevAudioTS, self.prevVideoTS)
+        if lastTS == INVALID_TIMESTAMP:
+            return None
+        return lastTS
+
+    def header(self):
+        return flvHeader(self.audio, self.video)
+
+    def fix(self, tag):
+        """
+        Return tag (header, data and previous tag size) repaired, or None
+        to drop it
+        """
+        packetType = ord(tag[0])
+        packetSize = readInt24(tag, 1)
+        packetTS = readInt24(tag, 4) | (ord(tag[7]) << 24)
+
+        # Try to fix the odd timestamps and make them zero based
+        currentTS = packetTS
+        lastTS = max(self.prevVideoTS, self.prevAudioTS)
+        fixedTS = lastTS + FRAMEFIX_STEP
+        if self.baseTS == INVALID_TIMESTAMP and packetType in (AUDIO, VIDEO):
+            self.baseTS = packetTS
+        if self.baseTS > 1000 and packetTS >= self.baseTS:
+            packetTS -= self.baseTS
+        if lastTS != INVALID_TIMESTAMP:
+            timeShift = packetTS - lastTS
+            if timeShift > self.fixWindow:
+                self.log("Timestamp gap detected: PacketTS=%d LastTS=%d Timeshift=%d" % (
+                    packetTS, lastTS, timeShift))
+                if self.baseTS < packetTS:
+                    self.baseTS += timeShift - FRAMEFIX_STEP
+                else:
+                    self.baseTS = timeShift - FRAMEFIX_STEP
+                packetTS = fixedTS
+            else:
+                lastTS = self.prevVideoTS if packetType == VIDEO else self.prevAudioTS
+                if packetTS < lastTS - self.fixWindow:
+                    if self.negTS != INVALID_TIMESTAMP and \
+                       packetTS + self.negTS < lastTS - self.fixWindow:
+                        self.negTS = INVALID_TIMESTAMP
+                    if self.negTS == INVALID_TIMESTAMP:
+                        self.negTS = fixedTS - packetTS
+                        self.log("Negative timestamp detected: PacketTS=%d LastTS=%d NegativeTS=%d" % (
+                            packetTS, lastTS, self.negTS))
+                        packetTS = fixedTS
+                    elif packetTS + self.negTS <= lastTS + self.fixWindow:
+                        packetTS += self.negTS
+                    else:
+                        self.negTS = fixedTS - packetTS
+                        self.log("Negative timestamp override: PacketTS=%d LastTS=%d NegativeTS=%d" % (
+                            packetTS, lastTS, self.negTS))
+                        packetTS = fixedTS
+        if packetTS != currentTS:
+            tag = setTimestamp(tag, packetTS)
+
+        if packetType == AUDIO:
+            return self.fixAudio(tag, packetSize, packetTS)
+        if packetType == VIDEO:
+            return self.fixVideo(tag, packetSize, packetTS)
+        if packetType == SCRIPT_DATA and self.metadata:
+            return tag
+        return None
+
+    def fixAudio(self, tag, packetSize, packetTS):
+        if packetTS <= self.prevAudioTS - self.fixWindow:
+            self.log("Skipping audio packet: %d %d" % (packetTS, self.prevAudioTS))
+            self.audio = True
+            return None
+        codecID = ord(tag[TagHeaderLen]) >> 4
+        aacPacketType = None
+        if codecID == CODEC_ID_AAC:
+            aacPacketType = ord(tag[TagHeaderLen + 1])
+            if aacPacketType == AAC_SEQUENCE_HEADER:
+                if self.aacHeaderWritten:
+                    self.log("Skipping AAC sequence header: %d" % packetTS)
+                    return None
+                self.log("Writing AAC sequence header")
+                self.aacHeaderWritten = True
+            elif not self.aacHeaderWritten:
+                self.log("Discarding audio packet received before AAC sequence header: %d" % packetTS)
+                return None
+        self.audio = True
+        if packetSize <= 0:
+            self.log("Skipping small sized audio packet: %d" % packetTS)
+            return None
+        # Check for packets with non-monotonic audio timestamps and fix them
+        if not (codecID == CODEC_ID_AAC and
+                (aacPacketType == AAC_SEQUENCE_HEADER or self.prevAACHeader)):
+            if self.prevAudioTS != INVALID_TIMESTAMP and packetTS <= self.prevAudioTS:
+                self.log("Fixing audio timestamp: %d %d" % (packetTS, self.prevAudioTS))
+                packetTS += FRAMEFIX_STEP // 5 + (self.prevAudioTS - packetTS)
+                tag = setTimestamp(tag, packetTS)
+        self.prevAACHeader = codecID == CODEC_ID_AAC and aacPacketType == AAC_SEQUENCE_HEADER
+        self.prevAudioTS = packetTS
+        return tag
+
+    def fixVideo(self, tag, packetSize, packetTS):
+        if packetTS <= self.prevVideoTS - self.fixWindow:
+            self.log("Skipping video packet: %d %d" % (packetTS, self.prevVideoTS))
+            self.video = True
+            return None
+        frameInfo = ord(tag[TagHeaderLen])
+        frameType = frameInfo >> 4
+        codecID = frameInfo & 0x0F
+        if frameType == FRAME_TYPE_INFO:
+            self.log("Skipping video info frame: %d" % packetTS)
+            return None
+        avcPacketType = None
+        if codecID == CODEC_ID_AVC:
+            avcPacketType = ord(tag[TagHeaderLen + 1])
+            if avcPacketType == AVC_SEQUENCE_HEADER:
+                if self.avcHeaderWritten:
+                    self.log("Skipping AVC sequence header: %d" % packetTS)
+                    return None
+                self.log("Writing AVC sequence header")
+                self.avcHeaderWritten = True
+            elif not self.avcHeaderWritten:
+                self.log("Discarding video packet received before AVC sequence header: %d" % packetTS)
+                return None
+        self.video = True
+        if packetSize <= 0:
+            self.log("Skipping small sized video packet: %d" % packetTS)
+            return None
+        # Check for packets with non-monotonic video timestamps and fix them
+        if not (codecID == CODEC_ID_AVC and
+                (avcPacketType in (AVC_SEQUENCE_HEADER, AVC_SEQUENCE_END) or self.prevAVCHeader)):
+            if self.prevVideoTS != INVALID_TIMESTAMP and packetTS <= self.prevVideoTS:
+                self.log("Fixing video timestamp: %d %d" % (packetTS, self.prevVideoTS))
+                packetTS += FRAMEFIX_STEP // 5 + (self.prevVideoTS - packetTS)
+                tag = setTimestamp(tag, packetTS)
+        self.prevAVCHeader = codecID == CODEC_ID_AVC and avcPacketType == AVC_SEQUENCE_HEADER
+        self.prevVideoTS = packetTS
+        return tag
+
+def fixFile(inFile, outFile, fixWindow=1000, metadata=True, debug=False, quiet=False):
+    """
+    Repair the FLV file inFile into outFile and return the FlvFixer used
+    """
+    fixer = FlvFixer(fixWindow, metadata, debug)
+    fileLen = os.path.getsize(inFile)
+    with open(inFile, "rb", 8 * 1024 * 1024) as flvIn:
+        if flvIn.read(len(FlvHeader))[:3] != "FLV":
+            raise ValueError("Input file is not a valid FLV file")
+        with open(outFile, "w+b", 8 * 1024 * 1024) as flvOut:
+            flvOut.write(FlvHeader)
+            filePos = len(FlvHeader)
+            pFilePos = 0
+            while filePos < fileLen:
+                header = flvIn.read(TagHeaderLen)
+                if len(header) < TagHeaderLen:
+                    fixer.log("Broken FLV tag encountered! Aborting further processing.")
+                    break
+                totalTagLen = TagHeaderLen + readInt24(header, 1) + PrevTagSize
+                tag = header + flvIn.read(totalTagLen - TagHeaderLen)
+                if len(tag) != totalTagLen:
+                    fixer.log("Broken FLV tag encountered! Aborting further processing.")
+                    break
+                tag = fixer.fix(tag)
+                if tag is not None:
+                    flvOut.write(tag)
+                filePos += totalTagLen
+                cFilePos = filePos // (1024 * 1024)
+                if cFilePos > pFilePos and not quiet:
+                    sys.stdout.write("Processed %d/%.2f MB\r" % (cFilePos, fileLen / (1024.0 * 1024)))
+                    pFilePos = cFilePos
+            flvOut.seek(0)
+            flvOut.write(fixer.header())
+    return fixer
+
+def beatConvert(beatFile, outFile, append=False, debug=False, quiet=False):
+    """
+    Convert the beat file beatFile to FLV, or with append add it to the
+    end of outFile when it exists, as BeatConvert.php does to join parts
+    """
+    if AES is None:
+        raise ImportError("Converting beat files needs PyCrypto (Crypto.Cipher.AES)")
+
+    def decrypt(data):
+        # mcrypt pads the last block with zeros
+        padded = data + "\0" * (-len(data) % 16)
+        return AES.new(key, AES.MODE_CBC, iv).decrypt(padded)
+
+    fileLen = os.path.getsize(beatFile)
+    with open(beatFile, "rb", 8 * 1024 * 1024) as beat:
+        # Parse beat file header
+        header = beat.read(3)
+        flags = ord(header[0])
+        quality = flags & 15
+        version = flags >> 4
+        lookupSize = UInt16.unpack_from(header, 1)[0]
+        encTable = beat.read(lookupSize)
+        if debug:
+            sys.stderr.write("Version: %d, Quality: %d, LookupSize: %d\n" % (version, quality, lookupSize))
+
+        # Retrieve encryption key and iv
+        keyIv = beat.read(32)
+        key = keyIv[0::2]
+        iv = keyIv[1::2]
+        decTable = decrypt(encTable)[:lookupSize]
+
+        # Check for existing flv file
+        avcCfgW = aacCfgW = append and os.path.exists(outFile)
+        with open(outFile, "ab" if avcCfgW else "wb") as flv:
+            if not avcCfgW:
+                flv.write(flvHeader())
+            filePos = 3 + lookupSize + 32
+            pFilePos = 0
+            decPos = 0
+            while decPos < len(decTable):
+                # Read table entry
+                flags = ord(decTable[decPos])
+                if flags == 0:
+                    break
+                packetType = flags >> 4
+                encrypted = flags & 4
+                keyframe = flags & 2
+                config = flags & 1
+                packetTime, dataLength = struct.unpack_from(">LL", decTable, decPos + 1)
+                decPos += 9
+                if encrypted:
+                    rawLength = UInt32.unpack_from(decTable, decPos)[0]
+                    decPos += 4
+                else:
+                    rawLength = dataLength
+                if debug:
+                    sys.stderr.write("Type: %d, Encrypted: %d, KeyFrame: %d, Config: %d, "
+                                     "Time: %d, DataLength: %d, RawLength: %d\n" % (
+                                     packetType, encrypted, keyframe, config,
+                                     packetTime, dataLength, rawLength))
+
+                # Decrypt encrypted tags
+                data = beat.read(dataLength)
+                if encrypted:
+                    data = decrypt(data)[:rawLength]
+                filePos += dataLength
+
+                if packetType == 1:
+                    # Video tag
+                    codecTag = ""
+                    if version == 2:
+                        codecTag = chr(7 | (16 if keyframe else 32)) + chr(0 if config else 1) + "\0\0\0"
+                    tagType = VIDEO
+                    if config:
+                        if avcCfgW:
+                            continue
+                        avcCfgW = True
+                elif packetType == 2:
+                    # Audio tag
+                    codecTag = ""
+                    if version == 2:
+                        codecTag = chr(175) + chr(0 if config else 1)
+                    tagType = AUDIO
+                    if config:
+                        if aacCfgW:
+                            continue
+                        aacCfgW = True
+                else:
+                    continue
+                tag = chr(tagType) + UInt32.pack(rawLength + len(codecTag))[1:]
+                tag = setTimestamp(tag + "\0" * 7, packetTime)
+                tag += codecTag + data
+                flv.write(tag + UInt32.pack(len(tag)))
+
+                cFilePos = filePos // (1024 * 1024)
+                if cFilePos > pFilePos and not quiet:
+                    sys.stdout.write("Processed %d/%.2f MB\r" % (cFilePos, fileLen / (1024.0 * 1024)))
+                    pFilePos = cFilePos
+
+def batchTasks(paths, outdir, beatOut="Final.flv"):
+    """
+    The (inputs, output) of the files in paths, files or directories:
+    each FLV file on its own, and all the beat files joined in order into
+    beatOut as BeatConvert.bat does.  Outputs never overwrite an input or
+    each other.
+    """
+    flvFiles = []
+    beatFiles = []
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(glob.glob(os.path.join(path, "*.flv")) +
+                           glob.glob(os.path.join(path, "*.beat")))
+        else:
+            files = [path]
+        for inFile in files:
+            if inFile.endswith(".beat"):
+                beatFiles.append(inFile)
+            else:
+                flvFiles.append(inFile)
+    inputs = set(os.path.abspath(inFile) for inFile in flvFiles + beatFiles)
+    outputs = set()
+
+    def outName(name):
+        outFile = os.path.join(outdir, name + ".flv")
+        count = 1
+        while os.path.abspath(outFile) in inputs or os.path.abspath(outFile) in outputs:
+            count += 1
+            outFile = os.path.join(outdir, "%s_%d.flv" % (name, count))
+        outputs.add(os.path.abspath(outFile))
+        return outFile
+
+    tasks = []
+    if beatFiles:
+        tasks.append((beatFiles, outName(os.path.splitext(beatOut)[0])))
+    for inFile in flvFiles:
+        name = os.path.splitext(os.path.basename(inFile))[0]
+        tasks.append(([inFile], outName(name)))
+    return tasks
+
+def runTask(args):
+    inFiles, outFile, fixWindow, metadata = args
+    st = time.time()
+    try:
+        if inFiles[0].endswith(".beat"):
+            for i, inFile in enumerate(inFiles):
+                beatConvert(inFile, outFile, append=i > 0, quiet=True)
+        else:
+            fixFile(inFiles[0], outFile, fixWindow, metadata, quiet=True)
+    except Exception as e:
+        return (inFiles, outFile, str(e), time.time() - st)
+    return (inFiles, outFile, None, time.time() - st)
+
+def batch(paths, outdir, processes=None, fixWindow=1000, metadata=True, beatOut="Final.flv"):
+    """
+    Repair or convert the files in paths into outdir, processes of them
+    at a time, and return the number that failed
+    """
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    tasks = [(inFiles, outFile, fixWindow, metadata)
+             for inFiles, outFile in batchTasks(paths, outdir, beatOut)]
+    failed = 0
+    pool = multiprocessing.Pool(processes)
+    try:
+        for inFiles, outFile, error, seconds in pool.imap_unordered(runTask, tasks):
+            if error:
+                failed += 1
+                print "%s: %s" % (", ".join(inFiles), error)
+            else:
+                print "%s -> %s in %.2f seconds" % (", ".join(inFiles), outFile, seconds)
+    finally:
+        pool.close()
+        pool.join()
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description='Repair FLV files and convert beat files to FLV')
+    parser.add_argument("--in", dest='infile', action='store',
+                        help='input filename of flv or beat file to be repaired')
+    parser.add_argument("--out", dest='outfile', action='store',
+                        help='output filename for repaired file')
+    parser.add_argument("--fixwindow", dest='fixwindow', action='store', type=int,
+                        help='timestamp gap between frames to consider as timeshift',
+                        default=1000)
+    parser.add_argument("--nometa", dest='nometa', action='store_true',
+                        help='do not save metadata in repaired file')
+    parser.add_argument("--debug", dest='debug', action='store_true',
+                        help='show debug output')
+    parser.add_argument("--append", dest='append', action='store_true',
+                        help='add the converted beat file to the end of the output '
+                        'file instead of replacing it')
+    parser.add_argument("--outdir", dest='outdir', action='store',
+                        help='output directory for the files and directories given')
+    parser.add_argument("--beatout", dest='beatout', action='store', default="Final.flv",
+                        help='name of the file the beat files given are joined into')
+    parser.add_argument("--processes", dest='processes', action='store', type=int,
+                        help='files to process at once (default: one per CPU)')
+    parser.add_argument("paths", nargs='*', help='files or directories to process')
+    args = parser.parse_args()
+
+    st = time.time()
+    if args.paths:
+        if not args.outdir:
+            parser.error("--outdir is needed to process several files")
+        failed = batch(args.paths, args.outdir, args.processes,
+                       args.fixwindow, not args.nometa, args.beatout)
+        print "Processed input files in %.2f seconds" % (time.time() - st)
+        sys.exit(1 if failed else 0)
+
+    if not args.infile:
+        parser.error("You must specify an input file")
+    if not os.path.exists(args.infile):
+        print "Input file doesn't exist"
+        sys.exit(1)
+    if args.infile.endswith(".beat"):
+        beatConvert(args.infile, args.outfile or "Final.flv", args.append, args.debug)
+    else:
+        if not args.outfile:
+            parser.error("You must specify an output file")
+        fixFile(args.infile, args.outfile, args.fixwindow, not args.nometa, args.debug)
+    print "Processed input file in %.2f seconds" % (time.time() - st)
+    print "Finished"
+
+if __name__ == "__main__":
+    main()